@@ -6,6 +6,7 @@ st.title("SCAV Video Transcoder")
 uploaded_file = st.file_uploader("Choose a video file", type=["mp4", "mov"])
 
 codec = st.selectbox("Select codec", ["vp8", "vp9", "h265", "av1"])
+preset = st.selectbox("Select preset", ["realtime", "fast", "balanced", "archive"], index=2)
 
 if st.button("Transcode Video"):
     if uploaded_file is not None:
@@ -13,8 +14,11 @@ if st.button("Transcode Video"):
         response = requests.post(
             "http://localhost:8000/process/convert_into_open_codecs/",
             files={"file": (uploaded_file.name, uploaded_file, uploaded_file.type)},
-            data={"codec": codec}
+            data={"codec": codec, "preset": preset, "delivery": "url"}
         )
         if response.status_code == 200:
-            st.download_button("Download Transcoded Video", response.content)
+            #the browser streams the result from the API (range requests), the GUI never holds the whole video
+            output_url = "http://localhost:8000" + response.json()["output_url"]
+            st.video(output_url)
+            st.markdown(f"[Download Transcoded Video]({output_url})")
         st.success("Transcoding completed!")
\ No newline at end of file
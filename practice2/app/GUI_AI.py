@@ -31,20 +31,18 @@ if uploaded_file is not None:
                     # .seek(0) és important per tornar a llegir l'arxiu des del principi
                     uploaded_file.seek(0) 
                     files = {"file": (uploaded_file.name, uploaded_file, uploaded_file.type)}
-                    data = {"codec": codec}
+                    data = {"codec": codec, "delivery": "url"}
                     
                     # Cridem l'endpoint que vas fer a l'ex 1
                     response = requests.post(f"{API_URL}/process/convert_into_open_codecs/", files=files, data=data)
                     
                     if response.status_code == 200:
                         st.success("Conversion successful!")
-                        # Botó per descarregar el resultat
-                        st.download_button(
-                            label="Download Converted Video",
-                            data=response.content,
-                            file_name=f"converted_{codec}_{uploaded_file.name}",
-                            mime="video/mp4"
-                        )
+                        # El navegador reprodueix el resultat directament de l'API (range requests),
+                        # així no el carreguem sencer a memòria
+                        output_url = API_URL + response.json()["output_url"]
+                        st.video(output_url)
+                        st.markdown(f"[Download Converted Video]({output_url})")
                     else:
                         st.error(f"Error {response.status_code}: {response.text}")
                         
@@ -0,0 +1,165 @@
+# Throughput benchmarks for the functions of the API
+# Run from the practice2 folder with: python -m app.benchmarks <name>
+import argparse
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import ffmpeg
+import numpy as np
+
+from . import s1_functions as s1
+from . import p2_functions as p2
+from .ffmpeg_pool import pool
+
+BIT_STREAM = Path(__file__).resolve().parents[2] / "bit_stream.txt"
+
+def timeit(function, *args, repeat=3):
+    # Best wall clock time of a few runs, in seconds
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def print_row(name, n_bytes, seconds):
+    print(f"{name:<32} {seconds * 1000:10.2f} ms {n_bytes / seconds / 1e6:10.1f} MB/s")
+
+def bench_rle(size_mb=8):
+    # Scale bit_stream.txt up to a multi-MB input by repeating it
+    seed = BIT_STREAM.read_bytes() if BIT_STREAM.exists() else b"0" * 50 + b"1" * 60 + b"0" * 2
+    data = (seed * (size_mb * 1024 * 1024 // len(seed) + 1))[:size_mb * 1024 * 1024]
+    print(f"Run length encoding of {len(data) / 1e6:.1f} MB")
+
+    #the loop implementation is far too slow for MBs, time it on a slice and extrapolate
+    sample = list(data[:len(data) // 16])
+    seconds, _ = timeit(s1.run_length_encoding, sample, repeat=1)
+    print_row("run_length_encoding (1/16)", len(sample), seconds)
+
+    seconds, (values, lengths) = timeit(s1.rle_encode, data)
+    print_row("rle_encode", len(data), seconds)
+    seconds, payload = timeit(s1.rle_to_bytes, values, lengths)
+    print_row("rle_to_bytes", len(data), seconds)
+    seconds, (values, lengths) = timeit(s1.rle_from_bytes, payload)
+    print_row("rle_from_bytes", len(data), seconds)
+    seconds, decoded = timeit(s1.rle_decode, values, lengths)
+    print_row("rle_decode", len(data), seconds)
+
+    assert decoded.tobytes() == data
+    print(f"Binary stream: {len(payload)} bytes ({len(payload) / len(data) * 100:.3f}% of the input)")
+
+def synthetic_plane(height, width, seed=0):
+    # Smooth gradient plus noise, closer to a real picture than pure noise
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    plane = 128 + 60 * np.sin(x / 37.0) * np.cos(y / 23.0) + rng.normal(0, 8, (height, width))
+    return np.clip(plane, 0, 255).astype(np.uint8)
+
+def bench_dct(quality=75):
+    plane = synthetic_plane(2160, 3840)
+    height, width = plane.shape
+    print(f"Blockwise 8x8 DCT of a {width}x{height} luma plane, quality {quality}")
+    encoder = s1.DCTEncoder()
+
+    seconds, coefficients = timeit(encoder.encode_blocks, plane, quality)
+    print_row("encode_blocks", plane.nbytes, seconds)
+    seconds, decoded = timeit(encoder.decode_blocks, coefficients, height, width, quality)
+    print_row("decode_blocks", plane.nbytes, seconds)
+
+    mse = np.mean((decoded - plane) ** 2)
+    print(f"PSNR after quantization: {10 * np.log10(255 ** 2 / mse):.2f} dB")
+
+def bench_dwt(levels=3):
+    plane = synthetic_plane(1080, 1920)
+    print("Haar DWT of a 1920x1080 grayscale frame")
+    encoder = s1.DWTEncoder()
+
+    seconds, _ = timeit(encoder.encode, plane)
+    print_row("encode (1 level, lifting)", plane.nbytes, seconds)
+    seconds, pyramid = timeit(encoder.encode_pyramid, plane, levels)
+    print_row(f"encode_pyramid ({levels} levels)", plane.nbytes, seconds)
+    seconds, decoded = timeit(encoder.decode, pyramid)
+    print_row(f"decode ({levels} levels)", plane.nbytes, seconds)
+    assert np.abs(decoded - plane).max() < 1e-3
+
+    try:
+        import pywt
+    except ImportError:
+        print("pywt is not installed, skipping the reference")
+        return
+    seconds, _ = timeit(encoder.encode_auto, plane)
+    print_row("encode_auto (pywt, 1 level)", plane.nbytes, seconds)
+    seconds, _ = timeit(pywt.wavedec2, plane, 'db1', 'symmetric', levels)
+    print_row(f"pywt.wavedec2 ({levels} levels)", plane.nbytes, seconds)
+
+def synthetic_clip(path, seconds=60, size="1280x720", rate=30, source="testsrc2", audio=True, crf=None):
+    # Reproducible test video made by ffmpeg itself (lavfi testsrc2 or mandelbrot) with a sine tone as audio
+    video = ffmpeg.input(f"{source}=size={size}:rate={rate}", f="lavfi", t=seconds)
+    options = {"vcodec": "libx264", "pix_fmt": "yuv420p", "g": 2 * rate}
+    if crf is not None:
+        options["crf"] = crf
+    if audio:
+        tone = ffmpeg.input("sine=frequency=440:sample_rate=48000", f="lavfi", t=seconds)
+        stream = ffmpeg.output(video, tone, str(path), acodec="aac", **options)
+    else:
+        stream = ffmpeg.output(video, str(path), **options)
+    pool.run(stream, overwrite_output=True, capture_stdout=True, capture_stderr=True)
+    return path
+
+def have_ffmpeg():
+    if shutil.which("ffmpeg") is None or shutil.which("ffprobe") is None:
+        print("ffmpeg/ffprobe not found in PATH, skipping")
+        return False
+    return True
+
+def bench_ladder():
+    if not have_ffmpeg():
+        return
+    with tempfile.TemporaryDirectory() as folder:
+        source = synthetic_clip(Path(folder) / "source.mp4")
+        print("Encoding ladder of a 60 s 1280x720 testsrc2 clip (rungs cut from 20 s to 50 s)")
+        for mode in p2.LADDER_MODES:
+            output_folder = Path(folder) / mode
+            output_folder.mkdir()
+            start = time.perf_counter()
+            p2.encoding_ladder(str(source), str(output_folder), mode=mode)
+            print(f"{mode:<32} {time.perf_counter() - start:10.2f} s")
+
+def bench_presets(seconds=4):
+    if not have_ffmpeg():
+        return
+    with tempfile.TemporaryDirectory() as folder:
+        source = synthetic_clip(Path(folder) / "source.mp4", seconds=seconds, size="640x360")
+        frames = seconds * 30
+        print(f"Encoder presets on a {seconds} s 640x360 testsrc2 clip")
+        print(f"{'codec':<8} {'preset':<10} {'fps':>10} {'size':>12}")
+        for codec in p2.OPEN_CODECS:
+            for preset in p2.ENCODER_PRESETS:
+                output = Path(folder) / f"{codec}_{preset}.mkv"
+                start = time.perf_counter()
+                p2.convert_into_open_codecs(str(source), str(output), codec, start=0, end=None, preset=preset)
+                fps = frames / (time.perf_counter() - start)
+                print(f"{codec:<8} {preset:<10} {fps:10.1f} {output.stat().st_size / 1024:9.0f} KiB")
+
+BENCHMARKS = {
+    "rle": bench_rle,
+    "dct": bench_dct,
+    "dwt": bench_dwt,
+    "ladder": bench_ladder,
+    "presets": bench_presets,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks of the SCAV API functions")
+    parser.add_argument("names", nargs="*", help=f"Benchmarks to run ({', '.join(BENCHMARKS)}), all by default")
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error(f"Unknown benchmark {name}, choose: {', '.join(BENCHMARKS)}")
+    for name in args.names or BENCHMARKS:
+        BENCHMARKS[name]()
+
+if __name__ == "__main__":
+    main()
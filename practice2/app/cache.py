@@ -0,0 +1,101 @@
+# Content addressed cache of processed outputs
+# The key is the hash of the input bytes plus the operation and its parameters, so uploading the same video with
+# the same parameters again returns the previous output instead of encoding it again.
+# Entries are evicted least recently used first when the cache grows over max_bytes.
+import hashlib
+import json
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+def link_or_copy(source, destination):
+    # Hard links are instant and take no space, copy when the two paths are on different file systems
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+class ResultCache:
+    def __init__(self, root, max_bytes=None):
+        self.root = Path(root)
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.environ.get("SCAV_CACHE_MAX_BYTES", 5 * 1024 ** 3))
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        # Rebuilds the LRU order from the modification times left by previous runs
+        if not self.root.exists():
+            return
+        files = [path for path in self.root.glob("*/*") if path.is_file() and not path.name.endswith(".tmp")]
+        for path in sorted(files, key=lambda path: path.stat().st_mtime):
+            self._entries[path.name] = (path, path.stat().st_size)
+
+    @staticmethod
+    def key(input_digest, operation, params):
+        description = json.dumps({"input": input_digest, "operation": operation, "params": params}, sort_keys=True)
+        return hashlib.sha256(description.encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return self.root / key[:2] / key
+
+    def fetch(self, key, destination):
+        # Puts the cached output at destination and returns True, or returns False on a miss
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return False
+            self._entries.move_to_end(key)
+            self.hits += 1
+            path = entry[0]
+            try:
+                link_or_copy(path, destination)
+                os.utime(path)
+            except OSError:
+                #the file went missing behind our back, forget it
+                del self._entries[key]
+                self.hits -= 1
+                self.misses += 1
+                return False
+        return True
+
+    def store(self, key, source):
+        source = Path(source)
+        if not source.is_file():
+            return
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = path.with_name(path.name + ".tmp")
+        link_or_copy(source, temp_path)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._entries[key] = (path, path.stat().st_size)
+            self._entries.move_to_end(key)
+            self._evict()
+
+    def _evict(self):
+        total = sum(size for _, size in self._entries.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            _, (path, size) = self._entries.popitem(last=False)
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": sum(size for _, size in self._entries.values()),
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
@@ -0,0 +1,179 @@
+# Codec comparison benchmark
+# Generates reproducible test clips with ffmpeg (lavfi testsrc2 and mandelbrot), encodes them with every open codec
+# and preset at a few target bitrates, and writes the encode wall time, CPU time, peak memory, output bitrate, PSNR
+# and SSIM of each encode to a CSV and a JSON report, with the BD-rate of every codec against an anchor codec.
+# Run from the practice2 folder with: python -m app.codec_benchmark --output codec_report
+import argparse
+import csv
+import json
+import math
+import os
+import re
+import tempfile
+import time
+from pathlib import Path
+
+import ffmpeg
+import numpy as np
+
+from . import p2_functions as p2
+from .benchmarks import synthetic_clip, have_ffmpeg
+from .ffmpeg_pool import pool
+from .probe import probe_video
+
+CLIP_SOURCES = ['testsrc2', 'mandelbrot']
+BITRATES = ['250k', '500k', '1000k', '2000k']
+REPORT_FIELDS = [
+    "clip", "codec", "preset", "target_bitrate", "wall_seconds", "cpu_seconds", "peak_rss_mib", "fps",
+    "bitrate_kbps", "size_bytes", "psnr", "ssim",
+]
+
+def run_measured(args, log_path):
+    # Runs a command line in its own process and returns (wall seconds, CPU seconds, peak RSS in MiB) of it.
+    # wait4 gives the resource usage of that process only, not of everything else the benchmark started
+    actions = [
+        (os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+        (os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+        (os.POSIX_SPAWN_OPEN, 2, str(log_path), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644),
+    ]
+    start = time.perf_counter()
+    pid = os.posix_spawnp(args[0], args, os.environ, file_actions=actions)
+    _, status, usage = os.wait4(pid, 0)
+    wall = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"{args[0]} failed: {Path(log_path).read_text(errors='replace')[-2000:]}")
+    #ru_maxrss is in KiB on Linux
+    return wall, usage.ru_utime + usage.ru_stime, usage.ru_maxrss / 1024
+
+def encode(source, output, codec, preset, bitrate, log_path):
+    # Same encoder and preset options as convert_into_open_codecs, at a target bitrate and without audio
+    vcodec, _ = p2.OPEN_CODECS[codec]
+    stream = ffmpeg.output(ffmpeg.input(str(source)).video, str(output), vcodec=vcodec, an=None,
+                           **p2.preset_options(codec, preset), **{'b:v': bitrate})
+    return run_measured(ffmpeg.compile(stream, overwrite_output=True), log_path)
+
+def quality(distorted, reference):
+    # (PSNR in dB, SSIM) of the whole distorted video against the reference, from ffmpeg's psnr and ssim filters
+    graph = "[0:v]split[d1][d2];[1:v]split[r1][r2];[d1][r1]psnr;[d2][r2]ssim"
+    args = ["ffmpeg", "-nostdin", "-i", str(distorted), "-i", str(reference), "-lavfi", graph, "-f", "null", "-"]
+    _, stderr = pool.submit_args(args, capture_stdout=True, capture_stderr=True).result()
+    stderr = stderr.decode("utf-8", "replace")
+    psnr = re.search(r"PSNR .*average:(\S+)", stderr)
+    ssim = re.search(r"SSIM .*All:(\S+)", stderr)
+    if psnr is None or ssim is None:
+        raise RuntimeError("ffmpeg did not report PSNR and SSIM")
+    return float(psnr.group(1)), float(ssim.group(1))
+
+def bd_rate(anchor, test):
+    # Bjøntegaard delta rate: average bitrate difference in % of test against anchor for the same quality.
+    # anchor and test are lists of (bitrate, quality); log(bitrate) is fitted as a polynomial of the quality
+    # (cubic with 4 points or more) and integrated over the quality range both curves cover.
+    # Negative means test needs less bitrate. None when the curves don't overlap or have too few points
+    anchor = [(rate, score) for rate, score in anchor if rate > 0 and math.isfinite(score)]
+    test = [(rate, score) for rate, score in test if rate > 0 and math.isfinite(score)]
+    degree = min(len(anchor), len(test), 4) - 1
+    if degree < 1:
+        return None
+    fits = []
+    for points in (anchor, test):
+        rates, scores = np.array(points).T
+        fits.append((np.polyint(np.polyfit(scores, np.log(rates), degree)), scores.min(), scores.max()))
+    low = max(fits[0][1], fits[1][1])
+    high = min(fits[0][2], fits[1][2])
+    if low >= high:
+        return None
+    areas = [np.polyval(fit, high) - np.polyval(fit, low) for fit, _, _ in fits]
+    return float((np.exp((areas[1] - areas[0]) / (high - low)) - 1) * 100)
+
+def compare(rows, anchor):
+    # BD-rate (PSNR and SSIM based) of every codec against the anchor codec, per clip and preset
+    curves = {}
+    for row in rows:
+        curves.setdefault((row["clip"], row["preset"], row["codec"]), []).append(row)
+    comparisons = []
+    for (clip, preset, codec), points in curves.items():
+        reference = curves.get((clip, preset, anchor))
+        if codec == anchor or reference is None:
+            continue
+        comparisons.append({
+            "clip": clip,
+            "preset": preset,
+            "codec": codec,
+            "anchor": anchor,
+            "bd_rate_psnr": bd_rate([(r["bitrate_kbps"], r["psnr"]) for r in reference], [(r["bitrate_kbps"], r["psnr"]) for r in points]),
+            "bd_rate_ssim": bd_rate([(r["bitrate_kbps"], r["ssim"]) for r in reference], [(r["bitrate_kbps"], r["ssim"]) for r in points]),
+        })
+    return comparisons
+
+def run_suite(folder, codecs, presets, bitrates, clips, seconds=3, size="640x360", rate=30):
+    # Encodes every clip with every codec, preset and bitrate. Returns one row (REPORT_FIELDS) per encode
+    rows = []
+    for clip in clips:
+        #nearly lossless source, so the metrics measure the codec under test and not the clip's own encode
+        source = synthetic_clip(Path(folder) / f"{clip}.mp4", seconds=seconds, size=size, rate=rate, source=clip, audio=False, crf=4)
+        frames = seconds * rate
+        for codec in codecs:
+            for preset in presets:
+                for bitrate in bitrates:
+                    output = Path(folder) / f"{clip}_{codec}_{preset}_{bitrate}.{p2.CODEC_EXTENSIONS[codec]}"
+                    wall, cpu, rss = encode(source, output, codec, preset, bitrate, Path(folder) / "encode.log")
+                    psnr, ssim = quality(output, source)
+                    size_bytes = output.stat().st_size
+                    row = {
+                        "clip": clip, "codec": codec, "preset": preset, "target_bitrate": bitrate,
+                        "wall_seconds": round(wall, 3), "cpu_seconds": round(cpu, 3), "peak_rss_mib": round(rss, 1),
+                        "fps": round(frames / wall, 2), "bitrate_kbps": round(size_bytes * 8 / probe_video(output).duration / 1000, 1),
+                        "size_bytes": size_bytes, "psnr": psnr, "ssim": ssim,
+                    }
+                    print(f"{clip:<11} {codec:<5} {preset:<9} {bitrate:>6} {row['fps']:8.1f} fps {row['cpu_seconds']:8.2f} s CPU "
+                          f"{row['peak_rss_mib']:7.1f} MiB {row['bitrate_kbps']:8.1f} kb/s {psnr:6.2f} dB SSIM {ssim:.4f}")
+                    output.unlink()
+                    rows.append(row)
+    return rows
+
+def write_report(output_folder, rows, comparisons, settings):
+    output_folder = Path(output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+    with open(output_folder / "encodes.csv", "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(output_folder / "report.json", "w") as file:
+        json.dump({"settings": settings, "encodes": rows, "bd_rate": comparisons}, file, indent=2)
+    return output_folder
+
+def split_list(text, choices, name):
+    values = [value.strip() for value in text.split(",") if value.strip()]
+    unknown = [value for value in values if choices is not None and value not in choices]
+    if not values:
+        raise argparse.ArgumentTypeError(f"Give at least one of the {name}")
+    if unknown:
+        raise argparse.ArgumentTypeError(f"Invalid {name} {', '.join(unknown)}, choose among: {', '.join(choices)}")
+    return values
+
+def main():
+    parser = argparse.ArgumentParser(description="Speed, memory and quality comparison of the open codecs")
+    parser.add_argument("--codecs", type=lambda text: split_list(text, p2.OPEN_CODECS, "codecs"), default=list(p2.OPEN_CODECS))
+    parser.add_argument("--presets", type=lambda text: split_list(text, p2.ENCODER_PRESETS, "presets"), default=list(p2.ENCODER_PRESETS))
+    parser.add_argument("--bitrates", type=lambda text: split_list(text, None, "bitrates"), default=BITRATES, help="Target bitrates, e.g. 250k,500k,1M")
+    parser.add_argument("--clips", type=lambda text: split_list(text, CLIP_SOURCES, "clips"), default=CLIP_SOURCES)
+    parser.add_argument("--seconds", type=int, default=3, help="Length of the test clips")
+    parser.add_argument("--size", default="640x360", help="Resolution of the test clips")
+    parser.add_argument("--anchor", default="vp9", choices=list(p2.OPEN_CODECS), help="Codec the BD-rates are computed against")
+    parser.add_argument("--output", default="codec_report", help="Folder for encodes.csv and report.json")
+    args = parser.parse_args()
+    if not have_ffmpeg():
+        return
+
+    with tempfile.TemporaryDirectory() as folder:
+        rows = run_suite(folder, args.codecs, args.presets, args.bitrates, args.clips, args.seconds, args.size)
+    comparisons = compare(rows, args.anchor)
+    for comparison in comparisons:
+        psnr, ssim = comparison["bd_rate_psnr"], comparison["bd_rate_ssim"]
+        print(f"BD-rate {comparison['clip']:<11} {comparison['preset']:<9} {comparison['codec']:<5} vs {args.anchor}: "
+              f"{'n/a' if psnr is None else f'{psnr:+.1f}%'} (PSNR) {'n/a' if ssim is None else f'{ssim:+.1f}%'} (SSIM)")
+    settings = {name: value for name, value in vars(args).items() if name != "output"}
+    print(f"Report written to {write_report(args.output, rows, comparisons, settings)}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+# Bounded executor for ffmpeg jobs
+# Every function that runs ffmpeg submits its command here instead of calling ffmpeg.run, so the number of
+# encoders running at the same time is limited (by default one per CPU) and the server never oversubscribes cores.
+import contextvars
+import json
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from contextlib import contextmanager
+
+import ffmpeg
+
+class QueueFull(Exception):
+    pass
+
+# Set (see FFmpegPool.waiting) in the callers that can wait for room in the queue instead of getting QueueFull
+_wait_for_room = contextvars.ContextVar("wait_for_room", default=False)
+
+class FFmpegJob:
+    # Handle of a submitted command: wait for it with result(), stop it with cancel()
+    def __init__(self, args, timeout, progress=None, reader=None):
+        self.args = args
+        self.timeout = timeout
+        self.progress = progress
+        self.reader = reader
+        self.process = None
+        self.future = None
+        self.cancelled = False
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            if self.future is not None and self.future.cancel():
+                return True
+            if self.process is not None and self.process.poll() is None:
+                self.process.kill()
+        return True
+
+    def done(self):
+        return self.future is not None and self.future.done()
+
+    def result(self, timeout=None):
+        return self.future.result(timeout)
+
+class FFmpegPool:
+    def __init__(self, max_workers=None, max_queue=None, timeout=None):
+        self.max_workers = max_workers or int(os.environ.get("SCAV_FFMPEG_WORKERS", 0)) or os.cpu_count() or 1
+        self.max_queue = max_queue if max_queue is not None else int(os.environ.get("SCAV_FFMPEG_QUEUE", 4 * self.max_workers))
+        self.timeout = timeout if timeout is not None else float(os.environ.get("SCAV_FFMPEG_TIMEOUT", 0)) or None
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ffmpeg")
+        self._lock = threading.Lock()
+        self._room = threading.Condition(self._lock)
+        self._queued = 0
+        self._running = 0
+        self._counters = {"submitted": 0, "completed": 0, "failed": 0, "timed_out": 0, "cancelled": 0, "rejected": 0}
+
+    def submit_args(self, args, timeout=None, capture_stdout=False, capture_stderr=False, input=None, progress=None, reader=None):
+        # Queues a command line, raises QueueFull when max_queue jobs are already waiting for a worker
+        # (inside waiting(), blocks until one of them starts instead).
+        # progress is called with the seconds of output written so far, parsed from ffmpeg's -progress output.
+        # reader, for outputs too big to keep in memory, is called in the worker with the stdout pipe and must read
+        # it to the end; what it returns replaces stdout in the result. It can't be combined with progress.
+        with self._lock:
+            while self._queued >= self.max_queue:
+                if not _wait_for_room.get():
+                    self._counters["rejected"] += 1
+                    raise QueueFull(f"ffmpeg queue is full ({self._queued} jobs waiting)")
+                self._room.wait()
+            self._queued += 1
+            self._counters["submitted"] += 1
+        args = list(args)
+        if progress is not None:
+            args[1:1] = ["-progress", "pipe:1", "-nostats"]
+        job = FFmpegJob(args, timeout if timeout is not None else self.timeout, progress, reader)
+        job.future = self._executor.submit(self._execute, job, capture_stdout, capture_stderr, input)
+        job.future.add_done_callback(lambda future: self._on_done(job, future))
+        return job
+
+    @contextmanager
+    def waiting(self):
+        # Submissions made in this block, and in threads started with a copy of its context, wait for room in a
+        # full queue instead of raising QueueFull. For background work that has no client to answer 503 to
+        token = _wait_for_room.set(True)
+        try:
+            yield
+        finally:
+            _wait_for_room.reset(token)
+
+    def submit(self, stream, overwrite_output=False, **kwargs):
+        return self.submit_args(ffmpeg.compile(stream, overwrite_output=overwrite_output), **kwargs)
+
+    def run(self, stream, overwrite_output=False, **kwargs):
+        # Drop in replacement of ffmpeg.run: blocks until the job ends and returns (stdout, stderr)
+        return self.submit(stream, overwrite_output=overwrite_output, **kwargs).result()
+
+    def probe(self, filename, timeout=None, **kwargs):
+        # Same as ffmpeg.probe, but sharing the concurrency limit of the pool
+        args = ["ffprobe", "-show_format", "-show_streams", "-of", "json"]
+        args += ffmpeg._utils.convert_kwargs_to_cmd_line_args(kwargs)
+        args += [filename]
+        stdout, _ = self.submit_args(args, timeout=timeout, capture_stdout=True, capture_stderr=True).result()
+        return json.loads(stdout.decode("utf-8"))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "queued": self._queued,
+                "running": self._running,
+                **self._counters,
+            }
+
+    def shutdown(self, cancel_pending=True):
+        self._executor.shutdown(wait=False, cancel_futures=cancel_pending)
+
+    def _execute(self, job, capture_stdout, capture_stderr, input):
+        with self._lock:
+            self._queued -= 1
+            self._running += 1
+            self._room.notify()
+        try:
+            with job._lock:
+                if job.cancelled:
+                    raise CancelledError()
+                job.started_at = time.monotonic()
+                job.process = subprocess.Popen(
+                    job.args,
+                    stdin=subprocess.PIPE if input is not None else None,
+                    stdout=subprocess.PIPE if capture_stdout or job.progress or job.reader else None,
+                    stderr=subprocess.PIPE if capture_stderr else None,
+                )
+            if job.progress is not None or job.reader is not None:
+                stdout, stderr = self._communicate_with_progress(job)
+            else:
+                try:
+                    stdout, stderr = job.process.communicate(input, timeout=job.timeout)
+                except subprocess.TimeoutExpired:
+                    job.process.kill()
+                    job.process.communicate()
+                    raise TimeoutError(f"ffmpeg job exceeded its timeout of {job.timeout} s")
+            if job.cancelled:
+                raise CancelledError()
+            if job.process.returncode != 0:
+                raise ffmpeg.Error(job.args[0], stdout, stderr)
+            return stdout, stderr
+        finally:
+            job.finished_at = time.monotonic()
+            with self._lock:
+                self._running -= 1
+
+    def _communicate_with_progress(self, job):
+        # Reads the key=value progress blocks from stdout, or hands stdout to the job's reader, while a timer
+        # enforces the timeout
+        timed_out = threading.Event()
+        def kill():
+            timed_out.set()
+            job.process.kill()
+        timer = threading.Timer(job.timeout, kill) if job.timeout else None
+        stderr = []
+        reader = None
+        if job.process.stderr is not None:
+            #drain stderr in parallel so a full pipe never blocks ffmpeg
+            reader = threading.Thread(target=lambda: stderr.append(job.process.stderr.read()), daemon=True)
+            reader.start()
+        if timer is not None:
+            timer.start()
+        stdout = None
+        try:
+            if job.reader is not None:
+                stdout = job.reader(job.process.stdout)
+            else:
+                for line in job.process.stdout:
+                    key, _, value = line.decode("utf-8", "replace").strip().partition("=")
+                    if key in ("out_time_us", "out_time_ms") and value.isdigit():
+                        #out_time_ms is also in microseconds, an old ffmpeg naming mistake
+                        job.progress(int(value) / 1e6)
+            job.process.wait()
+        except BaseException:
+            #a failed reader stops reading, ffmpeg would block on the full pipe forever
+            job.process.kill()
+            job.process.wait()
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if reader is not None:
+            reader.join()
+        if timed_out.is_set():
+            raise TimeoutError(f"ffmpeg job exceeded its timeout of {job.timeout} s")
+        return stdout, stderr[0] if stderr else None
+
+    def _on_done(self, job, future):
+        with self._lock:
+            if future.cancelled():
+                #cancelled before a worker picked it up, so _execute never decremented the queue
+                self._queued -= 1
+                self._counters["cancelled"] += 1
+                self._room.notify()
+                return
+            error = future.exception()
+            if error is None:
+                self._counters["completed"] += 1
+            elif isinstance(error, CancelledError):
+                self._counters["cancelled"] += 1
+            elif isinstance(error, TimeoutError):
+                self._counters["timed_out"] += 1
+            else:
+                self._counters["failed"] += 1
+
+# Shared pool used by s1_functions, s2_functions and p2_functions
+pool = FFmpegPool()
@@ -0,0 +1,206 @@
+# Background jobs for the long transcodes
+# A submitted job gets its own folder under JOBS_DIR with the uploaded input, its state is kept in a SQLite
+# database so that it can be polled (and restarted if the server goes down) while the encode runs.
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .ffmpeg_pool import pool
+
+JOBS_DIR = Path(os.environ.get("SCAV_JOBS_DIR", "jobs"))
+# Seconds a finished (done or failed) job, with its input and result, is kept before the sweep deletes it
+JOBS_MAX_AGE = float(os.environ.get("SCAV_JOBS_MAX_AGE", 24 * 3600))
+
+# Every kind of job: the function that runs it, and the media type of its result
+TASKS = {}
+
+def task(kind, media_type):
+    # Decorator to register a job function: function(input_path, output_dir, progress, **params) -> result path
+    def register(function):
+        TASKS[kind] = (function, media_type)
+        return function
+    return register
+
+class JobStore:
+    # Thin thread safe wrapper of the SQLite table of jobs
+    # The database is opened on first use, so importing the app doesn't create files in the working directory
+    def __init__(self, path):
+        self.path = Path(path)
+        self._sqlite = None
+        self._lock = threading.Lock()
+
+    @property
+    def _connection(self):
+        if self._sqlite is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            self._create_table(connection)
+            self._sqlite = connection
+        return self._sqlite
+
+    @staticmethod
+    def _create_table(connection):
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    progress REAL NOT NULL DEFAULT 0,
+                    params TEXT NOT NULL,
+                    input_path TEXT NOT NULL,
+                    result_path TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+
+    def create(self, job_id, kind, params, input_path):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO jobs (id, kind, state, params, input_path, created_at, updated_at) VALUES (?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(params), str(input_path), now, now),
+            )
+
+    def update(self, job_id, **fields):
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._connection:
+            self._connection.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def unfinished(self):
+        with self._lock:
+            rows = self._connection.execute("SELECT * FROM jobs WHERE state IN ('queued', 'running') ORDER BY created_at").fetchall()
+        return [dict(row) for row in rows]
+
+    def finished_before(self, timestamp):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?", (timestamp,)
+            ).fetchall()
+        return [row["id"] for row in rows]
+
+    def exists(self, job_id):
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM jobs WHERE id = ?", (job_id,)).fetchone() is not None
+
+    def delete(self, job_id):
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+class JobManager:
+    def __init__(self, jobs_dir=JOBS_DIR, max_workers=None, max_age=JOBS_MAX_AGE):
+        self.jobs_dir = Path(jobs_dir)
+        self.max_age = max_age
+        self.store = JobStore(self.jobs_dir / "jobs.sqlite3")
+        #the ffmpeg pool already bounds the encoders, this only bounds the threads waiting on them
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or 2 * (os.cpu_count() or 1), thread_name_prefix="job")
+
+    def job_dir(self, job_id):
+        return self.jobs_dir / job_id
+
+    def reserve(self):
+        # Reserves an id and a folder, the caller streams the input into the folder and then calls create and start
+        job_id = uuid.uuid4().hex
+        job_dir = self.job_dir(job_id)
+        job_dir.mkdir(parents=True)
+        return job_id, job_dir
+
+    def create(self, job_id, kind, params, input_path):
+        if kind not in TASKS:
+            raise ValueError(f"Unknown job kind {kind}")
+        self.store.create(job_id, kind, params, input_path)
+
+    def start(self, job_id):
+        self._executor.submit(self._run, job_id)
+
+    def resume(self):
+        # Jobs that were queued or running when the server stopped are started again from their saved input
+        for job in self.store.unfinished():
+            if Path(job["input_path"]).exists():
+                self.store.update(job["id"], state="queued", progress=0.0)
+                self.start(job["id"])
+            else:
+                self.store.update(job["id"], state="failed", error="Input lost after a server restart")
+
+    def status(self, job_id):
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        return {
+            "job_id": job["id"],
+            "kind": job["kind"],
+            "state": job["state"],
+            "progress": round(job["progress"] * 100, 1),
+            "params": json.loads(job["params"]),
+            "error": job["error"],
+            "created_at": job["created_at"],
+            "updated_at": job["updated_at"],
+        }
+
+    def result(self, job_id):
+        # (path, media type) of a finished job, or None
+        job = self.store.get(job_id)
+        if job is None or job["state"] != "done" or not job["result_path"]:
+            return None
+        return Path(job["result_path"]), TASKS[job["kind"]][1]
+
+    def delete(self, job_id):
+        shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+        self.store.delete(job_id)
+
+    def sweep(self):
+        # Deletes the jobs that finished more than max_age ago, folder and row, and the folders of uploads that
+        # never became a job (interrupted before create). Queued and running jobs are never touched.
+        if not self.jobs_dir.exists():
+            return {"removed": 0}
+        cutoff = time.time() - self.max_age
+        removed = 0
+        for job_id in self.store.finished_before(cutoff):
+            self.delete(job_id)
+            removed += 1
+        for entry in self.jobs_dir.iterdir():
+            try:
+                orphan = entry.is_dir() and entry.stat().st_mtime < cutoff and not self.store.exists(entry.name)
+            except OSError:
+                continue
+            if orphan:
+                shutil.rmtree(entry, ignore_errors=True)
+                removed += 1
+        return {"removed": removed}
+
+    def _run(self, job_id):
+        job = self.store.get(job_id)
+        function, _ = TASKS[job["kind"]]
+        output_dir = self.job_dir(job_id) / "output"
+        output_dir.mkdir(exist_ok=True)
+        self.store.update(job_id, state="running", progress=0.0)
+
+        last = [0.0]
+        def progress(fraction):
+            #skip the tiny steps so the database isn't written for every progress line
+            if fraction - last[0] >= 0.01 or fraction >= 1.0:
+                last[0] = fraction
+                self.store.update(job_id, progress=fraction)
+
+        try:
+            #a queued job waits for room in the ffmpeg queue instead of failing with QueueFull
+            with pool.waiting():
+                result_path = function(job["input_path"], str(output_dir), progress, **json.loads(job["params"]))
+            self.store.update(job_id, state="done", progress=1.0, result_path=str(result_path))
+        except Exception as e:
+            self.store.update(job_id, state="failed", error=str(e))
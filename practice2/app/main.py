@@ -1,18 +1,131 @@
 # main.py
-from fastapi import FastAPI, UploadFile, Form, File, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import FastAPI, UploadFile, Form, File, HTTPException, Request
+from fastapi.responses import Response
+from fastapi.concurrency import run_in_threadpool
 import shutil
 import os
+import io
+import asyncio
+import mimetypes
+from urllib.parse import quote
+from contextlib import asynccontextmanager
 from pathlib import Path
 import uvicorn
 import ffmpeg
+import numpy as np
+from PIL import Image
 
 from . import s1_functions as s1
 from . import s2_functions as s2
 from . import p2_functions as p2
-# Inicialitzem l'aplicació FastAPI
-app = FastAPI(title="API de la pràctica 1")
+from . import quality
+from .ffmpeg_pool import pool, QueueFull
+from .jobs import JobManager, task
+from .workspace import WorkspaceManager
+from .cache import ResultCache
+from .uploads import receive_upload, multipart_form, safe_filename, UploadError
+from .serving import conditional_file_response
+from .probe import probe_video_async, probes
+
 TEMP_DIR = Path("temp_uploads")
+SWEEP_INTERVAL = float(os.environ.get("SCAV_SWEEP_INTERVAL", 300))
+
+jobs = JobManager()
+workspaces = WorkspaceManager(TEMP_DIR)
+# HLS/DASH ladders are served segment by segment after the request, so they live longer in their own folder
+STREAMS_DIR = Path(os.environ.get("SCAV_STREAMS_DIR", "streams"))
+stream_folders = WorkspaceManager(STREAMS_DIR, max_age=float(os.environ.get("SCAV_STREAMS_MAX_AGE", 24 * 3600)))
+STREAM_MEDIA_TYPES = {
+    ".m3u8": "application/vnd.apple.mpegurl",
+    ".mpd": "application/dash+xml",
+    ".m4s": "video/iso.segment",
+    ".ts": "video/mp2t",
+    ".mp4": "video/mp4",
+}
+results = ResultCache(os.environ.get("SCAV_CACHE_DIR", "result_cache"))
+# Processed videos asked for with delivery=url are kept for a while at a stable URL (/outputs/...) that players can
+# stream and seek in, with their own age and size limits
+OUTPUTS_DIR = Path(os.environ.get("SCAV_OUTPUTS_DIR", "outputs"))
+output_folders = WorkspaceManager(
+    OUTPUTS_DIR,
+    max_age=float(os.environ.get("SCAV_OUTPUTS_MAX_AGE", 24 * 3600)),
+    max_bytes=int(os.environ.get("SCAV_OUTPUTS_MAX_BYTES", 10 * 1024 ** 3)),
+)
+DELIVERIES = ["file", "url"]
+
+async def sweep_temp_dir():
+    # Periodically removes leftovers from the temp dir and keeps it under its size quota
+    while True:
+        try:
+            await run_in_threadpool(workspaces.sweep)
+            await run_in_threadpool(stream_folders.sweep)
+            await run_in_threadpool(output_folders.sweep)
+            await run_in_threadpool(jobs.sweep)
+        except Exception as e:
+            print(f"Error sweeping the temp directory: {e}")
+        await asyncio.sleep(SWEEP_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app):
+    # Start again the jobs that were interrupted by a restart
+    jobs.resume()
+    sweeper = asyncio.create_task(sweep_temp_dir())
+    yield
+    sweeper.cancel()
+
+# Inicialitzem l'aplicació FastAPI
+app = FastAPI(title="API de la pràctica 1", lifespan=lifespan)
+
+def upload_name(file):
+    # Only the base name of the uploaded file, never a path chosen by the client
+    return safe_filename(file.filename)
+
+async def cached_process(operation, params, input_digest, output_path, function, *args, **kwargs):
+    # Runs function(*args, **kwargs) to produce output_path, unless the same input and parameters are already cached.
+    # The container comes from the name of the output, so its extension is part of the key too
+    key = results.key(input_digest, operation, {**params, "container": Path(output_path).suffix.lower()})
+    if await run_in_threadpool(results.fetch, key, output_path):
+        return True
+    await run_in_threadpool(function, *args, **kwargs)
+    await run_in_threadpool(results.store, key, output_path)
+    return False
+
+# Part of the video to process, every video endpoint takes it (each one keeps its old window as the default)
+WINDOW_FIELDS = {
+    "start": ("number", None, "Start of the part to process, in seconds"),
+    "end": ("number", None, "End of the part to process, in seconds (empty: until the end of the video)"),
+    "duration": ("number", None, "Length of the part to process, in seconds, instead of end"),
+}
+
+def read_window(upload, default):
+    try:
+        return s2.time_window(upload.field("start", float), upload.field("end", float), upload.field("duration", float), default)
+    except ValueError as e:
+        raise UploadError(str(e))
+
+def read_delivery(upload):
+    delivery = upload.field("delivery", str, "file")
+    if delivery not in DELIVERIES:
+        raise UploadError(f"Invalid delivery. Supported values: {', '.join(DELIVERIES)}")
+    return delivery
+
+def publish_output(output_path, filename):
+    # Moves a finished output out of the request workspace into its own folder under OUTPUTS_DIR
+    folder = output_folders.create()
+    target = folder / filename
+    shutil.move(str(output_path), target)
+    output_folders.hand_off(folder)
+    output_folders.release(folder)
+    return target, f"/outputs/{folder.name}/{quote(filename)}"
+
+async def output_response(workspace, output_path, filename, media_type, delivery):
+    # delivery=file returns the output, which is deleted with the workspace once it has been sent. delivery=url
+    # publishes it and returns only its stable URL, which supports range requests, so players and the GUI can
+    # stream the video instead of downloading it whole first
+    if delivery == "url":
+        path, url = await run_in_threadpool(publish_output, output_path, filename)
+        return {"output_url": url, "filename": filename, "media_type": media_type, "size": path.stat().st_size}
+    return workspaces.file_response(workspace, path=output_path, filename=filename, media_type=media_type)
 
 # Definim el primer endpoint (la ruta base o "root")
 @app.get("/")
@@ -24,6 +137,27 @@ def read_root():
 
 
 
+@app.get("/info/ffmpeg_pool/")
+def ffmpeg_pool_endpoint():
+    """Concurrency limit, queue depth and job counters of the ffmpeg executor."""
+    return pool.stats()
+
+@app.get("/info/result_cache/")
+def result_cache_endpoint():
+    """Size and hit/miss counters of the cache of processed videos."""
+    return results.stats()
+
+@app.get("/info/probe_cache/")
+def probe_cache_endpoint():
+    """Entries and hit/miss counters of the cache of ffprobe results."""
+    return probes.stats()
+
+@app.get("/info/temp_storage/")
+def temp_storage_endpoint():
+    """Request workspaces in use or waiting to be deleted in the temp directory."""
+    return workspaces.stats()
+
+
 # --- ENDPOINTS FOR S1 FUNCTIONS ---
 @app.post("/translate/rgb_to_yuv/")
 async def rgb_to_yuv_endpoint(
@@ -51,493 +185,841 @@ async def yuv_to_rgb_endpoint(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during YUV to RGB conversion: {str(e)}")
 
-@app.post("/process/resize_image/")
-async def resize_image_endpoint(
-    width: int = Form(-1),
-    height: int = Form(-1),
+def image_to_planar_yuv(content, standard, full_range):
+    #the bytes are in memory, so an OSError here means PIL can't decode them (not an image, truncated...)
+    try:
+        with Image.open(io.BytesIO(content)) as img:
+            pixels = np.asarray(img.convert("RGB"))
+    except (OSError, Image.DecompressionBombError):
+        raise ValueError("The uploaded file is not an image PIL can read")
+    height, width = pixels.shape[:2]
+    yuv = s1.traslator().rgb_to_yuv_frame(pixels, standard, full_range)
+    planar = np.clip(np.rint(yuv), 0, 255).astype(np.uint8).transpose(2, 0, 1)
+    return np.ascontiguousarray(planar).tobytes(), width, height
+
+@app.post("/translate/rgb_to_yuv_image/")
+async def rgb_to_yuv_image_endpoint(
+    standard: str = Form("bt601", description="Coefficients to use: bt601, bt709, bt2020"),
+    full_range: bool = Form(True),
     file: UploadFile = File(...)
 ):
-    # Clean the temp directory
-    if( TEMP_DIR.exists()):
-        for temp_file in os.listdir(TEMP_DIR):
-            temp_file_path = TEMP_DIR / temp_file
-            if temp_file_path.is_file():
-                os.remove(temp_file_path)
-
+    try:
+        #1 Read uploaded image
+        content = await file.read()
+
+        #2 Decode it and convert the whole frame at once with s1_functions, off the event loop:
+        planar, width, height = await run_in_threadpool(image_to_planar_yuv, content, standard, full_range)
+
+        #3 Return planar Y, U, V (yuv444p, 8 bits) as raw bytes
+        return Response(
+            content=planar,
+            media_type="application/octet-stream",
+            headers={
+                "Content-Disposition": f'attachment; filename="{Path(file.filename or "image").stem}_{width}x{height}.yuv"',
+                "X-Width": str(width),
+                "X-Height": str(height),
+                "X-Pixel-Format": "yuv444p",
+            },
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error during RGB to YUV image conversion: {str(e)}")
 
-    TEMP_DIR.mkdir(exist_ok = True)
-    #input_path = TEMP_DIR / file.filename
-    input_path = TEMP_DIR / (file.filename or "uploaded_file")
-    output_filename = f"resized_{width}x{height}_{file.filename}"
-    output_path = TEMP_DIR / output_filename
+@app.post("/process/resize_image/", openapi_extra=multipart_form(
+    width=("integer", -1, "Output width, -1 keeps the aspect ratio"),
+    height=("integer", -1, "Output height, -1 keeps the aspect ratio"),
+))
+async def resize_image_endpoint(request: Request):
+    # Private folder for this request, so parallel requests never touch each other's files
+    workspace = await run_in_threadpool(workspaces.create)
 
     try:
-        #1 Save uploaded file
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
+        #1 Stream uploaded file into the workspace
+        upload = await receive_upload(request, workspace, probe=False)
+        width = upload.field("width", int, -1)
+        height = upload.field("height", int, -1)
+        output_filename = f"resized_{width}x{height}_{upload.filename}"
+        output_path = workspace / output_filename
+
         #2 Process image with s1_functions:
-        s1.resize_image(str(input_path), str(output_path), width, height)
+        await run_in_threadpool(s1.resize_image, str(upload.path), str(output_path), width, height)
 
         #3 Return processed file:
-        return FileResponse(path=output_path, filename=output_filename, media_type='image/jpeg')
+        return workspaces.file_response(workspace, path=output_path, filename=output_filename, media_type='image/jpeg')
+
 
-    
-    
+
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during image resizing: {str(e)}")
     finally:
-        # Clean up temporary files
-        if input_path.exists():
-            os.remove(input_path)
-        # if output_path.exists():
-        #     os.remove(output_path)
+        # Clean up temporary files, a served output is deleted after the response is sent
+        await run_in_threadpool(workspaces.release, workspace)
 
-@app.post("/process/serpentine/")
-async def serpentine_endpoint(
-    file: UploadFile = File(...)
-):
+@app.post("/process/serpentine/", openapi_extra=multipart_form())
+async def serpentine_endpoint(request: Request):
 
-    TEMP_DIR.mkdir(exist_ok = True)
-    #input_path = TEMP_DIR / file.filename
-    input_path = TEMP_DIR / (file.filename or "uploaded_file")
+    workspace = await run_in_threadpool(workspaces.create)
 
     try:
-        #1 Save uploaded file
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
+        #1 Stream uploaded file into the workspace
+        upload = await receive_upload(request, workspace, probe=False)
+
         #2 Process image with s1_functions:
-        output_pixels = s1.serpentine(str(input_path))
+        output_pixels = await run_in_threadpool(s1.serpentine, str(upload.path))
 
         #3 Return processed data:
         return {"serpentine_pixels": output_pixels.tolist()}
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during serpentine reading: {str(e)}")
     finally:
-        # Clean up temporary files
-        if input_path.exists():
-            os.remove(input_path)
-
-@app.post("/process/bw_image/")
-async def bw_image_endpoint(
-    file: UploadFile = File(...)
-):
-    # Clean the temp directory
-    if( TEMP_DIR.exists()):
-        for temp_file in os.listdir(TEMP_DIR):
-            temp_file_path = TEMP_DIR / temp_file
-            if temp_file_path.is_file():
-                os.remove(temp_file_path)
-
-    TEMP_DIR.mkdir(exist_ok = True)
-    #input_path = TEMP_DIR / file.filename
-    input_path = TEMP_DIR / (file.filename or "uploaded_file")
+        # Clean up temporary files, a served output is deleted after the response is sent
+        await run_in_threadpool(workspaces.release, workspace)
 
-    output_filename = f"bw_{file.filename}"
-    output_path = TEMP_DIR / output_filename
+@app.post("/process/bw_image/", openapi_extra=multipart_form())
+async def bw_image_endpoint(request: Request):
+    # Private folder for this request, so parallel requests never touch each other's files
+    workspace = await run_in_threadpool(workspaces.create)
 
     try:
-        #1 Save uploaded file
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
+        #1 Stream uploaded file into the workspace
+        upload = await receive_upload(request, workspace, probe=False)
+        output_filename = f"bw_{upload.filename}"
+        output_path = workspace / output_filename
+
         #2 Process image with s1_functions:
-        s1.to_black_white(str(input_path), str(output_path))
+        await run_in_threadpool(s1.to_black_white, str(upload.path), str(output_path))
 
         #3 Return processed file:
-        return FileResponse(path=output_path, filename=output_filename, media_type='image/jpeg')
+        return workspaces.file_response(workspace, path=output_path, filename=output_filename, media_type='image/jpeg')
+
 
-    
-    
+
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during image conversion to B/W: {str(e)}")
     finally:
-        # Clean up temporary files
-        if input_path.exists():
-            os.remove(input_path)
-        #if output_path.exists():
-            #os.remove(output_path)
+        # Clean up temporary files, a served output is deleted after the response is sent
+        await run_in_threadpool(workspaces.release, workspace)
 
 @app.post("/process/run_length_encoding/")
 async def run_length_encoding_endpoint(
+    output_format: str = Form("json", description="json (list of [byte, count]) or binary (compact varint stream)"),
     file: UploadFile = File(...)
 ):
+    if output_format not in ["json", "binary"]:
+        raise HTTPException(status_code=400, detail="Invalid output format. Supported formats: json, binary")
+
     try:
         #1 Read uploaded file content as bytes
         file_content = await file.read()
-        byte_stream = list(file_content)
 
         #2 Process byte stream with s1_functions:
-        encoded_stream = s1.run_length_encoding(byte_stream)
+        values, lengths = await run_in_threadpool(s1.rle_encode, file_content)
 
         #3 Return encoded data:
-        return {"run_length_encoded": encoded_stream}
+        if output_format == "binary":
+            return Response(
+                content=await run_in_threadpool(s1.rle_to_bytes, values, lengths),
+                media_type="application/octet-stream",
+                headers={"Content-Disposition": f'attachment; filename="{upload_name(file)}.rle"'},
+            )
+        return {"run_length_encoded": list(zip(values.tolist(), lengths.tolist()))}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during Run Length Encoding: {str(e)}")
 
-
-# --- ENDPOINTS FOR S2 FUNCTIONS ---
-
-@app.post("/process/change_video_resolution/")
-async def change_video_resolution_endpoint(
-    width: int = Form(-1),
-    height: int = Form(-1),
+@app.post("/process/run_length_decoding/")
+async def run_length_decoding_endpoint(
     file: UploadFile = File(...)
 ):
-    # Clean the temp directory
-    if( TEMP_DIR.exists()):
-        for temp_file in os.listdir(TEMP_DIR):
-            temp_file_path = TEMP_DIR / temp_file
-            if temp_file_path.is_file():
-                os.remove(temp_file_path)
+    try:
+        #1 Read the binary stream produced by /process/run_length_encoding/
+        values, lengths = await run_in_threadpool(s1.rle_from_bytes, await file.read())
+
+        #2 Expand the runs back into the original bytes
+        decoded = await run_in_threadpool(s1.rle_decode, values, lengths)
+        return Response(content=decoded.tobytes(), media_type="application/octet-stream")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error during Run Length Decoding: {str(e)}")
 
 
-    TEMP_DIR.mkdir(exist_ok = True)
-    #input_path = TEMP_DIR / file.filename
-    input_path = TEMP_DIR / (file.filename or "uploaded_file")
-    output_filename = f"resized_{width}x{height}_{file.filename}"
-    output_path = TEMP_DIR / output_filename
+# --- ENDPOINTS FOR S2 FUNCTIONS ---
 
-    try:
-        #1 Save uploaded file
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        #2 Process video with s2_functions:
-        s2.change_video_resolution(str(input_path), str(output_path), width, height)
+@app.post("/process/cut/", openapi_extra=multipart_form(
+    **WINDOW_FIELDS,
+    mode=("string", "auto", "auto (stream copy when start is on a keyframe), copy (never re-encode, starts at the keyframe before start) or accurate (always re-encode)"),
+    delivery=("string", "file", "file returns the video, url returns a stable URL to stream it from"),
+))
+async def cut_endpoint(request: Request):
+    # Private folder for this request, so parallel requests never touch each other's files
+    workspace = await run_in_threadpool(workspaces.create)
 
-        #3 Return processed file:
-        return FileResponse(path=output_path, filename=output_filename, media_type='video/mp4')
+    try:
+        #1 Stream uploaded file into the workspace, hashing it on the way
+        upload = await receive_upload(request, workspace)
+        start, end = read_window(upload, (0, None))
+        mode = upload.field("mode", str, "auto")
+        if mode not in s2.CUT_MODES:
+            raise UploadError(f"Invalid cut mode. Supported modes: {', '.join(s2.CUT_MODES)}")
+        delivery = read_delivery(upload)
+        output_filename = f"cut_{upload.filename}"
+        output_path = workspace / output_filename
+
+        #2 Trim the video with s2_functions, without re-encoding when possible, or take it from the cache:
+        await cached_process(
+            "cut", {"start": start, "end": end, "mode": mode}, upload.digest, output_path,
+            s2.cut_video, str(upload.path), str(output_path), start, end, mode
+        )
+
+        #3 Return processed file, or the URL to stream it from:
+        return await output_response(workspace, output_path, output_filename, mimetypes.guess_type(output_filename)[0] or 'video/mp4', delivery)
+
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error during video cut: {str(e)}")
+    finally:
+        # Clean up temporary files, a served output is deleted after the response is sent
+        await run_in_threadpool(workspaces.release, workspace)
+
+@app.post("/process/change_video_resolution/", openapi_extra=multipart_form(
+    delivery=("string", "file", "file returns the video, url returns a stable URL to stream it from"),
+    width=("integer", -1, "Output width, -1 keeps the aspect ratio"),
+    height=("integer", -1, "Output height, -1 keeps the aspect ratio"),
+    **WINDOW_FIELDS,
+))
+async def change_video_resolution_endpoint(request: Request):
+    # Private folder for this request, so parallel requests never touch each other's files
+    workspace = await run_in_threadpool(workspaces.create)
 
-    
-    
+    try:
+        #1 Stream uploaded file into the workspace, hashing it on the way
+        upload = await receive_upload(request, workspace)
+        width = upload.field("width", int, -1)
+        height = upload.field("height", int, -1)
+        start, end = read_window(upload, (20, 50))
+        delivery = read_delivery(upload)
+        output_filename = f"resized_{width}x{height}_{upload.filename}"
+        output_path = workspace / output_filename
+
+        #2 Process video with s2_functions, or take it from the cache:
+        await cached_process(
+            "change_video_resolution", {"width": width, "height": height, "start": start, "end": end}, upload.digest, output_path,
+            s2.change_video_resolution, str(upload.path), str(output_path), width, height, start=start, end=end
+        )
+
+        #3 Return processed file, or the URL to stream it from:
+        return await output_response(workspace, output_path, output_filename, 'video/mp4', delivery)
+
+
+
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during video resizing: {str(e)}")
     finally:
-        # Clean up temporary files
-        if input_path.exists():
-            os.remove(input_path)
-        # if output_path.exists():
-        #     os.remove(output_path)
-
-@app.post("/process/change_chroma_subsampling/")
-async def change_chroma_subsampling_endpoint(
-    subsampling: str = Form("420p"),
-    file: UploadFile = File(...)
-):
-    # Clean the temp directory
-    if( TEMP_DIR.exists()):
-        for temp_file in os.listdir(TEMP_DIR):
-            temp_file_path = TEMP_DIR / temp_file
-            if temp_file_path.is_file():
-                os.remove(temp_file_path)
-
-
-    TEMP_DIR.mkdir(exist_ok = True)
-    #input_path = TEMP_DIR / file.filename
-    input_path = TEMP_DIR / (file.filename or "uploaded_file")
-    output_filename = f"subsampled_{subsampling}_{file.filename}"
-    output_path = TEMP_DIR / output_filename
-
-    if subsampling not in ["420p", "422p", "444p", "420p10le", "422p10le", "444p10le"]:
-        raise HTTPException(status_code=400, detail="Invalid subsampling format. Supported formats: 420p, 422p, 444p, 420p10le, 422p10le, 444p10le")
-    
+        # Clean up temporary files, a served output is deleted after the response is sent
+        await run_in_threadpool(workspaces.release, workspace)
+
+SUBSAMPLINGS = p2.SUBSAMPLINGS
+
+@app.post("/process/change_chroma_subsampling/", openapi_extra=multipart_form(
+    delivery=("string", "file", "file returns the video, url returns a stable URL to stream it from"),
+    subsampling=("string", "420p", f"One of {', '.join(SUBSAMPLINGS)}"),
+    **WINDOW_FIELDS,
+))
+async def change_chroma_subsampling_endpoint(request: Request):
+    # Private folder for this request, so parallel requests never touch each other's files
+    workspace = await run_in_threadpool(workspaces.create)
+
     try:
-        #1 Save uploaded file
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
+        #1 Stream uploaded file into the workspace
+        upload = await receive_upload(request, workspace)
+        subsampling = upload.field("subsampling", str, "420p")
+        if subsampling not in SUBSAMPLINGS:
+            raise UploadError(f"Invalid subsampling format. Supported formats: {', '.join(SUBSAMPLINGS)}")
+        start, end = read_window(upload, (0, None))
+        delivery = read_delivery(upload)
+        output_filename = f"subsampled_{subsampling}_{upload.filename}"
+        output_path = workspace / output_filename
+
         #2 Process video with s2_functions:
-        s2.change_chroma_subsampling(str(input_path), str(output_path), subsampling)
+        await run_in_threadpool(s2.change_chroma_subsampling, str(upload.path), str(output_path), subsampling, start, end)
 
-        #3 Return processed file:
-        return FileResponse(path=output_path, filename=output_filename, media_type='video/mp4')
+        #3 Return processed file, or the URL to stream it from:
+        return await output_response(workspace, output_path, output_filename, 'video/mp4', delivery)
 
-    
-    
+
+
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during chroma subsampling change: {str(e)}")
     finally:
-        # Clean up temporary files
-        if input_path.exists():
-            os.remove(input_path)
-        # if output_path.exists():
-        #     os.remove(output_path)
+        # Clean up temporary files, a served output is deleted after the response is sent
+        await run_in_threadpool(workspaces.release, workspace)
 
-@app.post("/info/video_info/")
-async def video_info_endpoint(
-    file: UploadFile = File(...)
-):
-    # Clean the temp directory
-    if( TEMP_DIR.exists()):
-        for temp_file in os.listdir(TEMP_DIR):
-            temp_file_path = TEMP_DIR / temp_file
-            if temp_file_path.is_file():
-                os.remove(temp_file_path)
-
-    TEMP_DIR.mkdir(exist_ok = True)
-    #input_path = TEMP_DIR / file.filename
-    input_path = TEMP_DIR / (file.filename or "uploaded_file")
+@app.post("/info/video_info/", openapi_extra=multipart_form())
+async def video_info_endpoint(request: Request):
+    # Private folder for this request, so parallel requests never touch each other's files
+    workspace = await run_in_threadpool(workspaces.create)
 
     try:
-        #1 Save uploaded file
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        #2 Get video info with s2_functions:
-        video_info = s2.get_video_info(str(input_path))
+        #1 Stream uploaded file into the workspace
+        upload = await receive_upload(request, workspace)
+
+        #2 Get video info with s2_functions, from a single cached probe:
+        await probe_video_async(upload.path, upload.digest)
+        video_info = await run_in_threadpool(s2.get_video_info, str(upload.path))
 
         #3 Return video info:
         return {"video_info": video_info}
 
-    
-    
+
+
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during video info retrieval: {str(e)}")
     finally:
-        # Clean up temporary files
-        if input_path.exists():
-            os.remove(input_path)
-
-@app.post("/process/process_bbb/")
-async def process_bbb_endpoint(
-    file: UploadFile = File(...)
-):
-    # Clean the temp directory
-    if( TEMP_DIR.exists()):
-        for temp_file in os.listdir(TEMP_DIR):
-            temp_file_path = TEMP_DIR / temp_file
-            if temp_file_path.is_file():
-                os.remove(temp_file_path)
-
-
-    TEMP_DIR.mkdir(exist_ok = True)
-    #input_path = TEMP_DIR / file.filename
-    input_path = TEMP_DIR / (file.filename or "uploaded_file")
+        # Clean up temporary files, a served output is deleted after the response is sent
+        await run_in_threadpool(workspaces.release, workspace)
+
+@app.post("/process/process_bbb/", openapi_extra=multipart_form(
+    delivery=("string", "file", "file returns the video, url returns a stable URL to stream it from"),
+    **WINDOW_FIELDS,
+))
+async def process_bbb_endpoint(request: Request):
+    # Private folder for this request, so parallel requests never touch each other's files
+    workspace = await run_in_threadpool(workspaces.create)
     output_filename = f"bbb_20s.mp4"
-    output_path = TEMP_DIR / output_filename
+    output_path = workspace / output_filename
 
     try:
-        #1 Save uploaded file
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
+        #1 Stream uploaded file into the workspace
+        upload = await receive_upload(request, workspace, prefix="input_")
+        start, end = read_window(upload, (0, 20))
+        delivery = read_delivery(upload)
+
         #2 Process video with s2_functions:
-        s2.process_bbb(str(input_path), str(output_path))
+        await run_in_threadpool(s2.process_bbb, str(upload.path), str(output_path), start, end)
+
+        #3 Return processed file, or the URL to stream it from:
+        return await output_response(workspace, output_path, output_filename, 'video/mp4', delivery)
+
 
-        #3 Return processed file:
-        return FileResponse(path=output_path, filename=output_filename, media_type='video/mp4')
 
-    
-    
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during BBB video processing: {str(e)}")
     finally:
-        # Clean up temporary files
-        if input_path.exists():
-            os.remove(input_path)
-        # if output_path.exists():
-        #     os.remove(output_path)
+        # Clean up temporary files, a served output is deleted after the response is sent
+        await run_in_threadpool(workspaces.release, workspace)
 
 
-@app.post("/info/count_tracks/")
-async def count_tracks_endpoint(
-    file: UploadFile = File(...)
-):
-    
-    # Clean the temp directory
-    if( TEMP_DIR.exists()):
-        for temp_file in os.listdir(TEMP_DIR):
-            temp_file_path = TEMP_DIR / temp_file
-            if temp_file_path.is_file():
-                os.remove(temp_file_path)
+@app.post("/info/count_tracks/", openapi_extra=multipart_form())
+async def count_tracks_endpoint(request: Request):
 
-    TEMP_DIR.mkdir(exist_ok = True)
-    #input_path = TEMP_DIR / file.filename
-    input_path = TEMP_DIR / (file.filename or "uploaded_file")
+    # Private folder for this request, so parallel requests never touch each other's files
+    workspace = await run_in_threadpool(workspaces.create)
 
 
     try:
-        #1 Save uploaded file
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        #2 Process video with s2_functions:
-        track_info = s2.count_tracks(str(input_path))
-        
+        #1 Stream uploaded file into the workspace
+        upload = await receive_upload(request, workspace)
+
+        #2 Process video with s2_functions, from a single cached probe:
+        await probe_video_async(upload.path, upload.digest)
+        track_info = await run_in_threadpool(s2.count_tracks, str(upload.path))
+
         #3 Return the value processed:
         return track_info
 
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during analyzing video container: {str(e)}")
     finally:
-        # Clean up temporary files
-        if input_path.exists():
-            os.remove(input_path)
-        # if output_path.exists():
-        #     os.remove(output_path)
-
+        # Clean up temporary files, a served output is deleted after the response is sent
+        await run_in_threadpool(workspaces.release, workspace)
 
-@app.post("/process/show_motion_vectors/")
-async def show_motion_vectors_endpoint(
-    file: UploadFile = File(...)
-):
-    # Clean the temp directory
-    if( TEMP_DIR.exists()):
-        for temp_file in os.listdir(TEMP_DIR):
-            temp_file_path = TEMP_DIR / temp_file
-            if temp_file_path.is_file():
-                os.remove(temp_file_path)
 
-
-    TEMP_DIR.mkdir(exist_ok = True)
-    #input_path = TEMP_DIR / file.filename
-    input_path = TEMP_DIR / (file.filename or "uploaded_file")
+@app.post("/process/show_motion_vectors/", openapi_extra=multipart_form(
+    delivery=("string", "file", "file returns the video, url returns a stable URL to stream it from"),
+    **WINDOW_FIELDS,
+))
+async def show_motion_vectors_endpoint(request: Request):
+    # Private folder for this request, so parallel requests never touch each other's files
+    workspace = await run_in_threadpool(workspaces.create)
     output_filename = f"bbb_motion_vectors.mp4"
-    output_path = TEMP_DIR / output_filename
+    output_path = workspace / output_filename
 
     try:
-        #1 Save uploaded file
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
+        #1 Stream uploaded file into the workspace
+        upload = await receive_upload(request, workspace, prefix="input_")
+        start, end = read_window(upload, (20, 50))
+        delivery = read_delivery(upload)
+
         #2 Process video with s2_functions:
-        s2.visualize_motion_vectors(str(input_path), str(output_path))
+        await run_in_threadpool(s2.visualize_motion_vectors, str(upload.path), str(output_path), start, end)
+
+        #3 Return processed file, or the URL to stream it from:
+        return await output_response(workspace, output_path, output_filename, 'video/mp4', delivery)
 
-        #3 Return processed file:
-        return FileResponse(path=output_path, filename=output_filename, media_type='video/mp4')
 
-    
-    
+
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during motion vectors video processing: {str(e)}")
     finally:
-        # Clean up temporary files
-        if input_path.exists():
-            os.remove(input_path)
-        # if output_path.exists():
-        #     os.remove(output_path)
+        # Clean up temporary files, a served output is deleted after the response is sent
+        await run_in_threadpool(workspaces.release, workspace)
 
 
 
-@app.post("/process/show_yuv_histogram/")
-async def show_yuv_histogram_endpoint(
-    file: UploadFile = File(...)
-):
-    # Clean the temp directory
-    if( TEMP_DIR.exists()):
-        for temp_file in os.listdir(TEMP_DIR):
-            temp_file_path = TEMP_DIR / temp_file
-            if temp_file_path.is_file():
-                os.remove(temp_file_path)
-
-
-    TEMP_DIR.mkdir(exist_ok = True)
-    #input_path = TEMP_DIR / file.filename
-    input_path = TEMP_DIR / (file.filename or "uploaded_file")
+@app.post("/process/show_yuv_histogram/", openapi_extra=multipart_form(
+    delivery=("string", "file", "file returns the video, url returns a stable URL to stream it from"),
+    **WINDOW_FIELDS,
+))
+async def show_yuv_histogram_endpoint(request: Request):
+    # Private folder for this request, so parallel requests never touch each other's files
+    workspace = await run_in_threadpool(workspaces.create)
     output_filename = f"yuv_histogram.mp4"
-    output_path = TEMP_DIR / output_filename
+    output_path = workspace / output_filename
 
     try:
-        #1 Save uploaded file
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
+        #1 Stream uploaded file into the workspace
+        upload = await receive_upload(request, workspace, prefix="input_")
+        start, end = read_window(upload, (20, 50))
+        delivery = read_delivery(upload)
+
         #2 Process video with s2_functions:
-        s2.show_yuv_histogram(str(input_path), str(output_path))
+        await run_in_threadpool(s2.show_yuv_histogram, str(upload.path), str(output_path), start, end)
+
+        #3 Return processed file, or the URL to stream it from:
+        return await output_response(workspace, output_path, output_filename, 'video/mp4', delivery)
 
-        #3 Return processed file:
-        return FileResponse(path=output_path, filename=output_filename, media_type='video/mp4')
 
-    
     except ffmpeg.Error as e:
         # AQUÍ ESTÀ LA MÀGIA: Retornem el missatge d'error real de FFmpeg
         # Així sabrem si és un problema de format, de filtre, o de què.
         error_message = e.stderr.decode('utf8')
         print(f"FFMPEG ERROR: {error_message}") # També ho imprimim al log
         raise HTTPException(status_code=500, detail=f"FFmpeg failed: {error_message}")
-    
+
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error during motion vectors video processing: {str(e)}")
     finally:
-        # Clean up temporary files
-        if input_path.exists():
-            os.remove(input_path)
-        # if output_path.exists():
-        #     os.remove(output_path)
+        # Clean up temporary files, a served output is deleted after the response is sent
+        await run_in_threadpool(workspaces.release, workspace)
 
 
+OPEN_CODECS = list(p2.OPEN_CODECS)
+LADDER_MODE_DESCRIPTION = "sequential, split (decode once, one ffmpeg process) or parallel (one process per rung at once)"
+LADDER_DESCRIPTION = 'JSON list of rungs, e.g. [{"width": 854, "height": 480, "bitrate": "1200k", "maxrate": "1800k", "bufsize": "2400k", "codec": "libx264", "crf": null}]'
 
-@app.post("/process/convert_into_open_codecs/")
-async def convert_into_open_codecs_endpoint(
-    codec: str = Form("vp8", description="Codec to convert into: vp8, vp9, h265, av1"),
-    file: UploadFile = File(...)
-):
-    # Clean the temp directory
-    if( TEMP_DIR.exists()):
-        for temp_file in os.listdir(TEMP_DIR):
-            temp_file_path = TEMP_DIR / temp_file
-            if temp_file_path.is_file():
-                os.remove(temp_file_path)
+CONVERT_MODE_DESCRIPTION = "single (one ffmpeg process) or chunked (pieces cut at keyframes encoded in parallel, for slow codecs like av1 and h265)"
+
+PRESET_DESCRIPTION = "Encoder speed/quality preset: realtime, fast, balanced or archive (slowest, smallest)"
 
+def read_convert_mode(upload):
+    mode = upload.field("mode", str, "single")
+    if mode not in p2.CONVERT_MODES:
+        raise UploadError(f"Invalid conversion mode. Supported modes: {', '.join(p2.CONVERT_MODES)}")
+    return mode
 
-    TEMP_DIR.mkdir(exist_ok=True)
-    input_path = TEMP_DIR / (file.filename or "uploaded_file")
-    output_filename = f"converted_{codec}_{file.filename}"
-    output_path = TEMP_DIR / output_filename
+def read_preset(upload):
+    preset = upload.field("preset", str, "balanced")
+    if preset not in p2.ENCODER_PRESETS:
+        raise UploadError(f"Invalid preset. Supported presets: {', '.join(p2.ENCODER_PRESETS)}")
+    return preset
 
+def read_ladder_fields(upload):
+    mode = upload.field("mode", str, "sequential")
+    if mode not in p2.LADDER_MODES:
+        raise UploadError(f"Invalid ladder mode. Supported modes: {', '.join(p2.LADDER_MODES)}")
     try:
-        #1 Save uploaded file
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        #2 Process video with p2_functions:
-        p2.convert_into_open_codecs(str(input_path), str(output_path), codec)
+        rungs = p2.load_ladder(upload.field("ladder"))
+    except ValueError as e:
+        raise UploadError(str(e))
+    return mode, rungs
+
+@app.post("/process/convert_into_open_codecs/", openapi_extra=multipart_form(
+    delivery=("string", "file", "file returns the video, url returns a stable URL to stream it from"),
+    codec=("string", "vp8", "Codec to convert into: vp8, vp9, h265, av1"),
+    mode=("string", "single", CONVERT_MODE_DESCRIPTION),
+    preset=("string", "balanced", PRESET_DESCRIPTION),
+    **WINDOW_FIELDS,
+))
+async def convert_into_open_codecs_endpoint(request: Request):
+    # Private folder for this request, so parallel requests never touch each other's files
+    workspace = await run_in_threadpool(workspaces.create)
+    codec = "vp8"
 
-        #3 Return processed file:
-        return FileResponse(path=output_path, filename=output_filename, media_type='video/mp4')
-    
+    try:
+        #1 Stream uploaded file into the workspace, hashing it on the way
+        upload = await receive_upload(request, workspace)
+        codec = upload.field("codec", str, "vp8")
+        mode = read_convert_mode(upload)
+        preset = read_preset(upload)
+        start, end = read_window(upload, (20, 50))
+        delivery = read_delivery(upload)
+        output_filename = f"converted_{codec}_{upload.filename}"
+        output_path = workspace / output_filename
+
+        #2 Process video with p2_functions, or take it from the cache:
+        await cached_process(
+            "convert_into_open_codecs", {"codec": codec, "start": start, "end": end, "mode": mode, "preset": preset},
+            upload.digest, output_path, p2.convert_into_open_codecs, str(upload.path), str(output_path), codec,
+            start=start, end=end, mode=mode, preset=preset
+        )
+
+        #3 Return processed file, or the URL to stream it from:
+        return await output_response(workspace, output_path, output_filename, 'video/mp4', delivery)
+
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error during video conversion to {codec}: {str(e)}")  
+        raise HTTPException(status_code=500, detail=f"Error during video conversion to {codec}: {str(e)}")
     finally:
-        # Clean up temporary files
-        if input_path.exists():
-            os.remove(input_path)
+        # Clean up temporary files, a served output is deleted after the response is sent
+        await run_in_threadpool(workspaces.release, workspace)
 
 
-@app.post("/process/encoding_ladder/")
-async def encoding_ladder_endpoint(
-    file: UploadFile = File(...)
-):
-    # Clean the temp directory
-    if( TEMP_DIR.exists()):
-        for temp_file in os.listdir(TEMP_DIR):
-            temp_file_path = TEMP_DIR / temp_file
-            if temp_file_path.is_file():
-                os.remove(temp_file_path)
+@app.post("/process/convert_into_multiple_codecs/", openapi_extra=multipart_form(
+    delivery=("string", "file", "file returns a zip of the videos, url returns a stable URL to stream each one from"),
+    codecs=("string", "vp8,vp9,h265,av1", "Comma separated codecs to convert into, the source is decoded only once"),
+    preset=("string", "balanced", PRESET_DESCRIPTION),
+    **WINDOW_FIELDS,
+))
+async def convert_into_multiple_codecs_endpoint(request: Request):
+    # Private folder for this request, so parallel requests never touch each other's files
+    workspace = await run_in_threadpool(workspaces.create)
+
+    try:
+        #1 Stream uploaded file into the workspace
+        upload = await receive_upload(request, workspace)
+        try:
+            codecs = p2.load_codecs(upload.field("codecs"))
+        except ValueError as e:
+            raise UploadError(str(e))
+        preset = read_preset(upload)
+        start, end = read_window(upload, (20, 50))
+        delivery = read_delivery(upload)
+        output_folder = workspace / "outputs"
+        output_folder.mkdir()
+
+        #2 Process video with p2_functions, every codec from the same decode:
+        outputs = await run_in_threadpool(
+            p2.convert_into_multiple_codecs, str(upload.path), str(output_folder), codecs, None, start, end, preset,
+            f"converted_{Path(upload.filename).stem}"
+        )
+
+        #3 Return the URLs to stream each video from, or the videos zipped on the fly:
+        if delivery == "url":
+            published = []
+            for codec, output_path in outputs.items():
+                filename = Path(output_path).name
+                path, url = await run_in_threadpool(publish_output, output_path, filename)
+                media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                published.append({"codec": codec, "output_url": url, "filename": filename, "media_type": media_type, "size": path.stat().st_size})
+            return {"outputs": published}
+        return workspaces.streaming_response(
+            workspace,
+            p2.stream_zip(list(outputs.values())),
+            media_type='application/zip',
+            headers={"Content-Disposition": 'attachment; filename="converted_codecs.zip"'},
+        )
+
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error during the multiple codec conversion: {str(e)}")
+    finally:
+        # Clean up temporary files, a served output is deleted after the response is sent
+        await run_in_threadpool(workspaces.release, workspace)
+
 
+PIPELINE_DESCRIPTION = (
+    'JSON list of steps run in one decode and one encode, e.g. [{"op": "cut", "start": 20, "end": 50}, '
+    '{"op": "resolution", "width": 1280, "height": -1}, {"op": "chroma_subsampling", "subsampling": "420p"}, '
+    '{"op": "codec", "codec": "vp9"}]. Steps: ' + ", ".join(p2.PIPELINE_STEPS)
+)
 
-    TEMP_DIR.mkdir(exist_ok=True)
-    input_path = TEMP_DIR / (file.filename or "uploaded_file")
-    output_folder = f"{file.filename}_encoding_ladder"
-    output_path = TEMP_DIR / output_folder
-    output_path.mkdir(exist_ok=True)
+@app.post("/process/pipeline/", openapi_extra=multipart_form(
+    steps=("string", None, PIPELINE_DESCRIPTION),
+    delivery=("string", "file", "file returns the video, url returns a stable URL to stream it from"),
+))
+async def pipeline_endpoint(request: Request):
+    # Private folder for this request, so parallel requests never touch each other's files
+    workspace = await run_in_threadpool(workspaces.create)
 
     try:
-        #1 Save uploaded file
-        with open(input_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-        
-        #2 Process video with p2_functions:
-        zip_file = p2.encoding_ladder(str(input_path), str(output_path))
+        #1 Stream uploaded file into the workspace, hashing it on the way
+        upload = await receive_upload(request, workspace)
+        try:
+            steps = p2.load_pipeline(upload.field("steps"))
+        except ValueError as e:
+            raise UploadError(str(e))
+        delivery = read_delivery(upload)
+        output_filename = f"pipeline_{Path(upload.filename).stem}.{p2.pipeline_extension(steps)}"
+        output_path = workspace / output_filename
+
+        #2 Run every step in a single ffmpeg pass with p2_functions, or take it from the cache:
+        await cached_process(
+            "pipeline", {"steps": steps}, upload.digest, output_path,
+            p2.run_pipeline, str(upload.path), str(output_path), steps
+        )
+
+        #3 Return processed file, or the URL to stream it from:
+        media_type = 'video/webm' if output_filename.endswith('.webm') else 'video/mp4'
+        return await output_response(workspace, output_path, output_filename, media_type, delivery)
+
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error during pipeline processing: {str(e)}")
+    finally:
+        # Clean up temporary files, a served output is deleted after the response is sent
+        await run_in_threadpool(workspaces.release, workspace)
 
-        #3 Return processed file:
-        return FileResponse(path=zip_file, filename="encoding_ladder.zip", media_type='application/zip')
-    
+
+@app.post("/info/quality/", openapi_extra=multipart_form(
+    steps=("string", None, "Processing to measure, as a pipeline: " + PIPELINE_DESCRIPTION),
+    per_frame=("boolean", True, "Return the scores of every frame, not only the summary"),
+))
+async def quality_endpoint(request: Request):
+    # Private folder for this request, so parallel requests never touch each other's files
+    workspace = await run_in_threadpool(workspaces.create)
+
+    try:
+        #1 Stream uploaded file into the workspace, hashing it on the way
+        upload = await receive_upload(request, workspace)
+        try:
+            steps = p2.load_pipeline(upload.field("steps"))
+        except ValueError as e:
+            raise UploadError(str(e))
+        per_frame = upload.field("per_frame", bool, True)
+        output_path = workspace / f"pipeline_{Path(upload.filename).stem}.{p2.pipeline_extension(steps)}"
+
+        #2 Process the video like /process/pipeline/ (sharing its cache) and score it against the source:
+        await cached_process(
+            "pipeline", {"steps": steps}, upload.digest, output_path,
+            p2.run_pipeline, str(upload.path), str(output_path), steps
+        )
+        cut = next((step for step in steps if step["op"] == "cut"), {"start": 0.0, "end": None})
+        scores = await run_in_threadpool(quality.compare_videos, str(upload.path), str(output_path), cut["start"], cut["end"], per_frame)
+
+        #3 Return the summary and the scores of every frame:
+        return {"steps": steps, **scores}
+
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error during encoding ladder processing: {str(e)}")  
+        raise HTTPException(status_code=500, detail=f"Error during quality measurement: {str(e)}")
     finally:
         # Clean up temporary files
-        if input_path.exists():
-            os.remove(input_path)
\ No newline at end of file
+        await run_in_threadpool(workspaces.release, workspace)
+
+@app.post("/process/encoding_ladder/", openapi_extra=multipart_form(
+    mode=("string", "sequential", LADDER_MODE_DESCRIPTION),
+    ladder=("string", None, LADDER_DESCRIPTION),
+    packaging=("string", "zip", "zip (MP4 files), hls (fMP4 segments), hls_ts (TS segments) or dash"),
+    **WINDOW_FIELDS,
+))
+async def encoding_ladder_endpoint(request: Request):
+    # Private folder for this request, so parallel requests never touch each other's files
+    workspace = await run_in_threadpool(workspaces.create)
+    stream_folder = None
+
+    try:
+        #1 Stream uploaded file into the workspace
+        upload = await receive_upload(request, workspace)
+        mode, rungs = read_ladder_fields(upload)
+        packaging = upload.field("packaging", str, "zip")
+        if packaging not in p2.PACKAGING_FORMATS:
+            raise UploadError(f"Invalid packaging. Supported formats: {', '.join(p2.PACKAGING_FORMATS)}")
+        window = read_window(upload, (20, 50))
+
+        output_path = workspace / f"{upload.filename}_encoding_ladder"
+        if packaging != "zip":
+            #segments are written where /streams/ serves them from
+            stream_folder = await run_in_threadpool(stream_folders.create)
+            output_path = stream_folder
+        output_path.mkdir(exist_ok=True)
+
+        #2 Process video with p2_functions, as a segmented stream:
+        if stream_folder is not None:
+            manifest = await run_in_threadpool(p2.encoding_ladder, str(upload.path), str(output_path), None, mode, rungs, packaging, window)
+            stream_folders.hand_off(stream_folder)
+            stream_id = stream_folder.name
+            return {
+                "stream_id": stream_id,
+                "packaging": packaging,
+                "manifest_url": f"/streams/{stream_id}/{Path(manifest).name}",
+            }
+
+        #   or as MP4 files
+        files = await run_in_threadpool(p2.encoding_ladder_files, str(upload.path), str(output_path), None, mode, rungs, window)
+
+        #3 Return the files zipped on the fly, no archive is written to disk:
+        return workspaces.streaming_response(
+            workspace,
+            p2.stream_zip(files),
+            media_type='application/zip',
+            headers={"Content-Disposition": 'attachment; filename="encoding_ladder.zip"'},
+        )
+
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except QueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error during encoding ladder processing: {str(e)}")
+    finally:
+        # Clean up temporary files, a served output is deleted after the response is sent
+        await run_in_threadpool(workspaces.release, workspace)
+        if stream_folder is not None:
+            await run_in_threadpool(stream_folders.release, stream_folder)
+
+@app.get("/streams/{stream_id}/{file_path:path}")
+async def stream_file_endpoint(request: Request, stream_id: str, file_path: str):
+    # Playlists and segments of a packaged ladder, straight from its folder
+    root = (STREAMS_DIR / stream_id).resolve()
+    path = (root / file_path).resolve()
+    if root.parent != STREAMS_DIR.resolve() or not path.is_relative_to(root) or not path.is_file():
+        raise HTTPException(status_code=404, detail="File not found")
+    return conditional_file_response(request, path, media_type=STREAM_MEDIA_TYPES.get(path.suffix, "application/octet-stream"))
+
+@app.get("/outputs/{output_id}/{filename}")
+async def output_file_endpoint(request: Request, output_id: str, filename: str):
+    # Processed videos published with delivery=url,
+    # served inline with range requests so a player can seek without downloading the whole file
+    root = (OUTPUTS_DIR / output_id).resolve()
+    path = (root / filename).resolve()
+    if root.parent != OUTPUTS_DIR.resolve() or path.parent != root or not path.is_file():
+        raise HTTPException(status_code=404, detail="File not found")
+    media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+    return conditional_file_response(request, path, media_type=media_type)
+
+
+# --- BACKGROUND JOBS FOR LONG TRANSCODES ---
+
+@task("convert_into_open_codecs", "video/mp4")
+def convert_into_open_codecs_task(input_path, output_dir, progress, codec, start=20, end=50, mode="single", preset="balanced"):
+    output_path = Path(output_dir) / f"converted_{codec}_{Path(input_path).name.removeprefix('input_')}"
+    return p2.convert_into_open_codecs(
+        input_path, str(output_path), codec, progress=progress, start=start, end=end, mode=mode, preset=preset
+    )
+
+@task("encoding_ladder", "application/zip")
+def encoding_ladder_task(input_path, output_dir, progress, mode="sequential", ladder=None, start=20, end=50):
+    return p2.encoding_ladder(input_path, output_dir, progress=progress, mode=mode, ladder=ladder, window=(start, end))
+
+async def submit_job(request, kind, read_params):
+    # Streams the upload straight into the job folder, read_params(upload) validates the form fields
+    job_id, job_dir = await run_in_threadpool(jobs.reserve)
+    try:
+        upload = await receive_upload(request, job_dir, prefix="input_")
+        await run_in_threadpool(jobs.create, job_id, kind, read_params(upload), upload.path)
+    except Exception:
+        await run_in_threadpool(jobs.delete, job_id)
+        raise
+    jobs.start(job_id)
+    return {"job_id": job_id, "status_url": f"/jobs/{job_id}", "result_url": f"/jobs/{job_id}/result"}
+
+@app.post("/jobs/convert_into_open_codecs/", openapi_extra=multipart_form(
+    codec=("string", "vp8", "Codec to convert into: vp8, vp9, h265, av1"),
+    mode=("string", "single", CONVERT_MODE_DESCRIPTION),
+    preset=("string", "balanced", PRESET_DESCRIPTION),
+    **WINDOW_FIELDS,
+))
+async def convert_into_open_codecs_job_endpoint(request: Request):
+    def read_params(upload):
+        codec = upload.field("codec", str, "vp8")
+        if codec not in OPEN_CODECS:
+            raise UploadError(f"Invalid codec. Supported codecs: {', '.join(OPEN_CODECS)}")
+        start, end = read_window(upload, (20, 50))
+        return {"codec": codec, "start": start, "end": end, "mode": read_convert_mode(upload), "preset": read_preset(upload)}
+
+    try:
+        return await submit_job(request, "convert_into_open_codecs", read_params)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error submitting the conversion job: {str(e)}")
+
+@app.post("/jobs/encoding_ladder/", openapi_extra=multipart_form(
+    mode=("string", "sequential", LADDER_MODE_DESCRIPTION),
+    ladder=("string", None, LADDER_DESCRIPTION),
+    **WINDOW_FIELDS,
+))
+async def encoding_ladder_job_endpoint(request: Request):
+    def read_params(upload):
+        mode, rungs = read_ladder_fields(upload)
+        start, end = read_window(upload, (20, 50))
+        return {"mode": mode, "ladder": rungs, "start": start, "end": end}
+
+    try:
+        return await submit_job(request, "encoding_ladder", read_params)
+    except UploadError as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error submitting the encoding ladder job: {str(e)}")
+
+@app.get("/jobs/{job_id}")
+async def job_status_endpoint(job_id: str):
+    status = await run_in_threadpool(jobs.status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return status
+
+@app.get("/jobs/{job_id}/result")
+async def job_result_endpoint(request: Request, job_id: str):
+    status = await run_in_threadpool(jobs.status, job_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    result = await run_in_threadpool(jobs.result, job_id)
+    if result is None:
+        raise HTTPException(status_code=409, detail=f"Job is {status['state']}, no result available")
+    path, media_type = result
+    return conditional_file_response(request, path, media_type=media_type, filename=path.name)
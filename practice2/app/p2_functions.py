@@ -1,60 +1,625 @@
 import ffmpeg
+from .ffmpeg_pool import pool, QueueFull
 from . import s2_functions as s2
+from .probe import probe_video
 import zipfile
 import os
+import shutil
+import json
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 
-def convert_into_open_codecs(input_video_path, output_video_path, codec):
+# Video and audio encoder of every open codec
+OPEN_CODECS = {
+    'vp8': ('libvpx', 'libvorbis'),
+    'vp9': ('libvpx-vp9', 'libvorbis'),
+    'h265': ('libx265', 'aac'),
+    'av1': ('libaom-av1', 'libopus'),
+}
+
+# Speed/quality presets of the open codec encoders, from fastest to smallest output at the same quality.
+# Each one is (libvpx, libvpx-vp9, libx265, libaom-av1) options; preset_options adds the threads when they are given
+ENCODER_PRESETS = {
+    'realtime': {
+        'vp8': {'deadline': 'realtime', 'cpu-used': 8},
+        'vp9': {'deadline': 'realtime', 'cpu-used': 8, 'row-mt': 1, 'tile-columns': 2},
+        'h265': {'preset': 'ultrafast'},
+        'av1': {'usage': 'realtime', 'cpu-used': 8, 'row-mt': 1, 'tiles': '2x2'},
+    },
+    'fast': {
+        'vp8': {'deadline': 'good', 'cpu-used': 4},
+        'vp9': {'deadline': 'good', 'cpu-used': 4, 'row-mt': 1, 'tile-columns': 2},
+        'h265': {'preset': 'veryfast'},
+        'av1': {'cpu-used': 6, 'row-mt': 1, 'tiles': '2x2'},
+    },
+    'balanced': {
+        'vp8': {'deadline': 'good', 'cpu-used': 1},
+        'vp9': {'deadline': 'good', 'cpu-used': 2, 'row-mt': 1, 'tile-columns': 1},
+        'h265': {'preset': 'medium'},
+        'av1': {'cpu-used': 4, 'row-mt': 1, 'tiles': '2x1'},
+    },
+    'archive': {
+        'vp8': {'deadline': 'best', 'cpu-used': 0},
+        'vp9': {'deadline': 'good', 'cpu-used': 0, 'row-mt': 1},
+        'h265': {'preset': 'slower'},
+        'av1': {'cpu-used': 1, 'row-mt': 1},
+    },
+}
+
+def preset_options(codec, preset='balanced', threads=None):
+    # Output options of the video encoder of codec for a preset. Without threads the encoder picks its own thread
+    # count from the CPUs (ffmpeg's auto), the callers that run several encoders at once give each one its share
+    if preset not in ENCODER_PRESETS:
+        raise ValueError(f"Invalid preset, choose: {', '.join(ENCODER_PRESETS)}")
+    options = dict(ENCODER_PRESETS[preset][codec])
+    if threads:
+        #x265 ignores -threads and sizes its own thread pool
+        if codec == 'h265':
+            options['x265-params'] = f"pools={threads}"
+        else:
+            options['threads'] = threads
+    return options
+
+CONVERT_MODES = ['single', 'chunked']
+# Shortest chunk of a chunked encode, in seconds: shorter ones spend more time starting encoders than encoding
+MIN_CHUNK_SECONDS = 2.0
+
+def convert_into_open_codecs(input_video_path, output_video_path, codec, progress=None, start=20, end=50, mode='single', preset='balanced'):
     # Function to convert an input video into VP8, VP9, h265 and AV1 codecs
-    stream = ffmpeg.input(input_video_path, ss=20, to=50)
-    if codec == 'vp8':
-        stream = ffmpeg.output(stream, output_video_path, vcodec='libvpx', acodec='libvorbis')
-    elif codec == 'vp9':
-        stream = ffmpeg.output(stream, output_video_path, vcodec='libvpx-vp9', acodec='libvorbis')
-    elif codec == 'h265':
-        stream = ffmpeg.output(stream, output_video_path, vcodec='libx265', acodec='aac')
-    elif codec == 'av1':
-        stream = ffmpeg.output(stream, output_video_path, vcodec='libaom-av1', acodec='libopus')
-    else:
+    # mode chunked encodes pieces of the video in parallel, see convert_chunked. preset is one of ENCODER_PRESETS
+    if codec not in OPEN_CODECS:
         raise ValueError("You put an invalid codec, choose: vp8, vp9, h265 or av1")
+    if mode not in CONVERT_MODES:
+        raise ValueError(f"Invalid conversion mode, choose: {', '.join(CONVERT_MODES)}")
+    if mode == 'chunked':
+        return convert_chunked(input_video_path, output_video_path, codec, progress, start, end, preset=preset)
+    vcodec, acodec = OPEN_CODECS[codec]
+    stream = ffmpeg.input(input_video_path, **s2.seek_options(start, end))
+    stream = ffmpeg.output(stream, output_video_path, vcodec=vcodec, acodec=acodec, **preset_options(codec, preset), **s2.faststart(output_video_path))
     
     #execute the conversion to the choosen codec, it overwrites the output if exists
-    stream.run(overwrite_output=True)
-
-def encoding_ladder(input_video_path, output_folder):
+    duration = s2.cut_duration(input_video_path, start, end) if progress else 0
+    pool.run(stream, overwrite_output=True, progress=s2.progress_reporter(progress, duration))
+    return output_video_path
 
-    # This array contains the resolutions which the video will be scaled to.
-    # found that if the resolution is higher than the original it outputs an error
-    res_bitrate = [
-        ('426', '240'),
-        ('854', '480'),
-        ('1280', '720'), 
-        #('1920', '1080'),
+def window_frames(input_video_path, start=0.0, end=None):
+    # (pts, is keyframe) of the video frames between start and end, in seconds from the beginning of the file
+    # like -ss counts them (ffprobe timestamps also include the start time of the container)
+    offset = probe_video(input_video_path).start_time
+    packets = s2.video_packets(input_video_path, start + offset, end + offset if end is not None else None)
+    return [
+        (pts - offset, key) for pts, key in packets
+        if pts - offset >= start - 1e-6 and (end is None or pts - offset < end - 1e-6)
     ]
 
-    #array of the path of the generated videos
-    generated_video_files = []
+def plan_chunks(frames, workers, min_seconds=MIN_CHUNK_SECONDS):
+    # Splits the frames of the window at keyframes into about one chunk per worker, none shorter than min_seconds.
+    # The encoders put a keyframe on their own scene cuts, so these are also the scene cuts of the source.
+    # Returns (start, frame count) of every chunk
+    if not frames:
+        return []
+    length = max((frames[-1][0] - frames[0][0]) / workers, min_seconds)
+    starts = [0]
+    for index, (pts, key) in enumerate(frames):
+        if key and index and pts - frames[starts[-1]][0] >= length:
+            starts.append(index)
+    #a short tail joins the chunk before it
+    if len(starts) > 1 and frames[-1][0] - frames[starts[-1]][0] < min_seconds:
+        starts.pop()
+    bounds = starts + [len(frames)]
+    return [(frames[first][0], last - first) for first, last in zip(bounds, bounds[1:])]
+
+def convert_chunked(input_video_path, output_video_path, codec, progress=None, start=20, end=50, workers=None, preset='balanced'):
+    # Slow encoders (libaom-av1, libx265) use few cores on a single stream. This cuts the window at keyframes,
+    # encodes the video of every chunk in its own ffmpeg process, all side by side in the ffmpeg pool, and joins
+    # them without re-encoding with the concat demuxer. The audio is encoded once over the whole window, so it
+    # has no gaps at the joins. Raises ValueError when the output does not have the frames and length of the source
+    vcodec, acodec = OPEN_CODECS[codec]
+    start, end = start or 0.0, end
+    frames = window_frames(input_video_path, start, end)
+    if not frames:
+        raise ValueError("There are no video frames in the selected time window")
+    chunks = plan_chunks(frames, workers or pool.max_workers)
+    #the encoders running at once share the CPUs
+    encoder_options = preset_options(codec, preset, threads=max((os.cpu_count() or 1) // min(len(chunks), pool.max_workers), 1))
+    chunk_folder = output_video_path + ".chunks"
+    os.makedirs(chunk_folder, exist_ok=True)
+
+    fractions = [0.0] * len(chunks)
+    def chunk_progress(index, count):
+        if not progress:
+            return None
+        def report(fraction):
+            #each chunk weighs as many frames as it has
+            fractions[index] = fraction * count / len(frames)
+            progress(min(sum(fractions), 1.0))
+        return report
+
+    def encode_chunk(index, chunk_start, count):
+        #matroska holds every open codec, every chunk starts on its own keyframe.
+        #vsync, not fps_mode: the ffmpeg 4.3 of the Docker image doesn't know fps_mode (5.1+), 7.x still accepts vsync
+        chunk_path = os.path.join(chunk_folder, f"chunk_{index:04d}.mkv")
+        stream = ffmpeg.input(input_video_path, ss=chunk_start) if chunk_start else ffmpeg.input(input_video_path)
+        stream = ffmpeg.output(stream.video, chunk_path, vcodec=vcodec, vsync='passthrough', **encoder_options, **{'frames:v': count})
+        seconds = count / len(frames) * (frames[-1][0] - frames[0][0]) or 1.0
+        pool.run(stream, overwrite_output=True, progress=s2.progress_reporter(chunk_progress(index, count), seconds))
+        return chunk_path
+
+    try:
+        with ThreadPoolExecutor(max_workers=min(len(chunks), pool.max_workers)) as executor:
+            #each thread runs in a copy of the caller's context, so a job's chunks wait for room in the ffmpeg queue too
+            futures = [executor.submit(contextvars.copy_context().run, encode_chunk, index, *chunk) for index, chunk in enumerate(chunks)]
+            chunk_paths = [future.result() for future in futures]
+
+        #the paths hold the uploaded filename: a ' is closed, escaped and reopened as the concat demuxer expects
+        list_path = os.path.join(chunk_folder, "chunks.txt")
+        with open(list_path, "w") as list_file:
+            list_file.writelines("file '{}'\n".format(os.path.abspath(path).replace("'", "'\\''")) for path in chunk_paths)
+        video = ffmpeg.input(list_path, f='concat', safe=0).video
+        streams = [video]
+        options = {'vcodec': 'copy'}
+        if probe_video(input_video_path).count('audio'):
+            streams.append(ffmpeg.input(input_video_path, **s2.seek_options(start, end)).audio)
+            options['acodec'] = acodec
+        stream = ffmpeg.output(*streams, output_video_path, **options, **s2.faststart(output_video_path))
+        pool.run(stream, overwrite_output=True)
+    finally:
+        shutil.rmtree(chunk_folder, ignore_errors=True)
+
+    #accuracy check: same frames and the same length as the window of the source
+    output_frames = len(window_frames(output_video_path))
+    if output_frames != len(frames):
+        raise ValueError(f"The chunked encode has {output_frames} frames instead of {len(frames)}")
+    video = probe_video(output_video_path).video
+    frame_duration = 1 / video.frame_rate if video and video.frame_rate else 0.05
+    expected = s2.cut_duration(input_video_path, start, end)
+    duration = probe_video(output_video_path).duration
+    if abs(duration - expected) > max(2 * frame_duration, 0.1):
+        raise ValueError(f"The chunked encode lasts {duration:.3f} s instead of {expected:.3f} s")
+    return output_video_path
+
+# Container of the files of convert_into_multiple_codecs, one that holds the video and audio codec of each
+CODEC_EXTENSIONS = {'vp8': 'webm', 'vp9': 'webm', 'h265': 'mp4', 'av1': 'mp4'}
+
+def load_codecs(spec):
+    # Validated list of codecs from a comma separated string like "vp9,av1", all of them when empty
+    codecs = [codec.strip() for codec in (spec or ",".join(OPEN_CODECS)).split(",") if codec.strip()]
+    unknown = [codec for codec in codecs if codec not in OPEN_CODECS]
+    if unknown or not codecs:
+        raise ValueError(f"Invalid codecs {', '.join(unknown)}, choose among: {', '.join(OPEN_CODECS)}")
+    return list(dict.fromkeys(codecs))
+
+def convert_into_multiple_codecs(input_video_path, output_folder, codecs, progress=None, start=20, end=50, preset='balanced', name="converted"):
+    # A single ffmpeg process: the source is decoded once and split (and asplit) filters feed one encoder per
+    # codec, instead of decoding it again for every codec. Returns {codec: output path}
+    outputs = {codec: os.path.join(output_folder, f"{name}_{codec}.{CODEC_EXTENSIONS[codec]}") for codec in codecs}
+    source = ffmpeg.input(input_video_path, **s2.seek_options(start, end))
+    videos = source.video.filter_multi_output('split', len(codecs))
+    audios = source.audio.filter_multi_output('asplit', len(codecs)) if probe_video(input_video_path).count('audio') else None
+    #the encoders run at the same time and share the CPUs
+    threads = max((os.cpu_count() or 1) // len(codecs), 1)
+
+    streams = []
+    for index, (codec, output) in enumerate(outputs.items()):
+        vcodec, acodec = OPEN_CODECS[codec]
+        inputs = [videos.stream(index)] + ([audios.stream(index)] if audios is not None else [])
+        options = {'vcodec': vcodec, **preset_options(codec, preset, threads), **s2.faststart(output)}
+        if audios is not None:
+            options['acodec'] = acodec
+        streams.append(ffmpeg.output(*inputs, output, **options))
+    duration = s2.cut_duration(input_video_path, start, end) if progress else 0
+    pool.run(ffmpeg.merge_outputs(*streams), overwrite_output=True, progress=s2.progress_reporter(progress, duration))
+    return outputs
+
+# Steps of a pipeline and their parameters, the same ones as the single operation endpoints
+PIPELINE_STEPS = {
+    'cut': {'start': 0.0, 'end': None},
+    'resolution': {'width': -1, 'height': -1},
+    'chroma_subsampling': {'subsampling': '420p'},
+    'black_white': {},
+    'motion_vectors': {},
+    'codec': {'codec': 'vp8'},
+}
+SUBSAMPLINGS = ["420p", "422p", "444p", "420p10le", "422p10le", "444p10le"]
+
+def load_pipeline(spec):
+    # Validated list of steps from a JSON string or a list of dicts like {"op": "resolution", "width": 1280}.
+    # cut and codec may appear once each, the filters run in the order they are listed.
+    if isinstance(spec, str):
+        try:
+            spec = json.loads(spec)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"The pipeline is not valid JSON: {e}")
+    if not isinstance(spec, list) or not spec:
+        raise ValueError("The pipeline must be a non empty list of steps")
+
+    steps = []
+    for step in spec:
+        if not isinstance(step, dict) or step.get("op") not in PIPELINE_STEPS:
+            raise ValueError(f"Each step must be an object with an op: {', '.join(PIPELINE_STEPS)}")
+        defaults = PIPELINE_STEPS[step["op"]]
+        unknown = set(step) - set(defaults) - {"op"}
+        if unknown:
+            raise ValueError(f"Unknown fields for {step['op']}: {', '.join(sorted(unknown))}")
+        steps.append({"op": step["op"], **defaults, **{name: step[name] for name in defaults if name in step}})
+
+    for op in ('cut', 'codec'):
+        if sum(step["op"] == op for step in steps) > 1:
+            raise ValueError(f"The pipeline can only have one {op} step")
+    for step in steps:
+        try:
+            if step["op"] == 'cut':
+                step["start"] = float(step["start"] or 0)
+                step["end"] = float(step["end"]) if step["end"] is not None else None
+                if step["start"] < 0 or (step["end"] is not None and step["end"] <= step["start"]):
+                    raise ValueError("A cut needs 0 <= start < end")
+            elif step["op"] == 'resolution':
+                step["width"], step["height"] = int(step["width"]), int(step["height"])
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"Invalid {step['op']} step: {e}")
+        if step["op"] == 'chroma_subsampling' and step["subsampling"] not in SUBSAMPLINGS:
+            raise ValueError(f"Invalid subsampling, choose: {', '.join(SUBSAMPLINGS)}")
+        if step["op"] == 'codec' and step["codec"] not in OPEN_CODECS:
+            raise ValueError(f"Invalid codec, choose: {', '.join(OPEN_CODECS)}")
+    return steps
+
+def pipeline_extension(steps):
+    # VP8/VP9 with Vorbis go in WebM, everything else in MP4
+    codec = next((step["codec"] for step in steps if step["op"] == 'codec'), None)
+    return 'webm' if codec in ('vp8', 'vp9') else 'mp4'
+
+def compile_pipeline(input_video_path, output_video_path, steps):
+    # Builds one ffmpeg command for the whole pipeline: the cut becomes input options, the other steps one filter
+    # chain in their order, and the codec the output encoders. The source is decoded and encoded a single time.
+    input_options = {}
+    output_options = dict(s2.faststart(output_video_path))
+    filters = []
+    for step in steps:
+        if step["op"] == 'cut':
+            input_options["ss"] = step["start"]
+            if step["end"] is not None:
+                input_options["to"] = step["end"]
+        elif step["op"] == 'resolution':
+            filters.append(('scale', (step["width"], step["height"]), {}))
+        elif step["op"] == 'chroma_subsampling':
+            filters.append(('format', (f"yuv{step['subsampling']}",), {}))
+        elif step["op"] == 'black_white':
+            filters.append(('format', ('gray',), {}))
+        elif step["op"] == 'motion_vectors':
+            #the decoder has to export the vectors for codecview to draw them
+            input_options["flags2"] = '+export_mvs'
+            filters.append(('codecview', (), {'mv': 'pf+bf+bb'}))
+        elif step["op"] == 'codec':
+            output_options["vcodec"], output_options["acodec"] = OPEN_CODECS[step["codec"]]
+
+    source = ffmpeg.input(input_video_path, **input_options)
+    video = source.video
+    for name, args, kwargs in filters:
+        video = video.filter(name, *args, **kwargs)
+    streams = [video]
+    if probe_video(input_video_path).count('audio'):
+        streams.append(source.audio)
+    return ffmpeg.output(*streams, output_video_path, **output_options)
+
+def run_pipeline(input_video_path, output_video_path, steps, progress=None):
+    steps = load_pipeline(steps)
+    if [step["op"] for step in steps] == ['cut']:
+        #nothing to filter or encode: a stream copy when the cut starts on a keyframe
+        s2.cut_video(input_video_path, output_video_path, steps[0]["start"], steps[0]["end"], progress=progress)
+        return output_video_path
+    stream = compile_pipeline(input_video_path, output_video_path, steps)
+    cut = next((step for step in steps if step["op"] == 'cut'), None)
+    duration = 0
+    if progress:
+        duration = s2.cut_duration(input_video_path, cut["start"], cut["end"] or float('inf')) if cut else probe_video(input_video_path).duration
+    pool.run(stream, overwrite_output=True, progress=s2.progress_reporter(progress, duration))
+    return output_video_path
+
+LADDER_MODES = ['sequential', 'split', 'parallel']
+
+# Default rungs: resolution, target bitrate and VBV limits for x264.
+# Can be replaced with a JSON file (list of rungs) given in SCAV_LADDER_CONFIG or with the ladder of the request.
+DEFAULT_LADDER = [
+    {"width": 426, "height": 240, "codec": "libx264", "bitrate": "400k", "maxrate": "600k", "bufsize": "800k", "crf": None},
+    {"width": 854, "height": 480, "codec": "libx264", "bitrate": "1200k", "maxrate": "1800k", "bufsize": "2400k", "crf": None},
+    {"width": 1280, "height": 720, "codec": "libx264", "bitrate": "2800k", "maxrate": "4200k", "bufsize": "5600k", "crf": None},
+    {"width": 1920, "height": 1080, "codec": "libx264", "bitrate": "5000k", "maxrate": "7500k", "bufsize": "10000k", "crf": None},
+]
+RUNG_FIELDS = ["width", "height", "codec", "bitrate", "maxrate", "bufsize", "crf"]
+
+def load_ladder(spec=None):
+    # Validated list of rungs from a JSON string or a list of dicts, by default the configured ladder
+    if spec is None:
+        config_path = os.environ.get("SCAV_LADDER_CONFIG")
+        if not config_path:
+            return [dict(rung) for rung in DEFAULT_LADDER]
+        with open(config_path) as config:
+            spec = json.load(config)
+    if isinstance(spec, str):
+        try:
+            spec = json.loads(spec)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"The ladder is not valid JSON: {e}")
+    if not isinstance(spec, list) or not spec:
+        raise ValueError("The ladder must be a non empty list of rungs")
+
+    rungs = []
+    for rung in spec:
+        if not isinstance(rung, dict):
+            raise ValueError("Each rung must be an object")
+        unknown = set(rung) - set(RUNG_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown rung fields: {', '.join(sorted(unknown))}")
+        try:
+            width, height = int(rung["width"]), int(rung["height"])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError("Each rung needs an integer width and height")
+        if width <= 0 or height <= 0:
+            raise ValueError("Rung width and height must be positive")
+        crf = rung.get("crf")
+        if crf is not None and not 0 <= float(crf) <= 63:
+            raise ValueError("Rung crf must be between 0 and 63")
+        rungs.append({
+            "width": width,
+            "height": height,
+            "codec": rung.get("codec") or "libx264",
+            "bitrate": rung.get("bitrate"),
+            "maxrate": rung.get("maxrate"),
+            "bufsize": rung.get("bufsize"),
+            "crf": crf,
+        })
+    return rungs
+
+def prune_ladder(rungs, source_width, source_height):
+    # Drops the rungs bigger than the source, upscaling only wastes bits.
+    # If the source is smaller than every rung, the smallest rung is kept at the source resolution.
+    kept = [rung for rung in rungs if rung["width"] <= source_width and rung["height"] <= source_height]
+    if not kept:
+        smallest = min(rungs, key=lambda rung: rung["width"] * rung["height"])
+        kept = [dict(smallest, width=source_width, height=source_height)]
+    return kept
+
+def rung_output_options(rung):
+    options = {"vcodec": rung["codec"]}
+    if rung["bitrate"]:
+        options["b:v"] = rung["bitrate"]
+    if rung["maxrate"]:
+        options["maxrate"] = rung["maxrate"]
+    if rung["bufsize"]:
+        options["bufsize"] = rung["bufsize"]
+    if rung["crf"] is not None:
+        options["crf"] = rung["crf"]
+    return options
+
+def ladder_output_path(output_folder, rung):
+    return os.path.join(output_folder, f"video_{rung['width']}x{rung['height']}.mp4")
+
+def encode_rung(input_video_path, output_folder, rung, progress=None, window=(20, 50)):
+    # Returns (output path, encode seconds). window is the (start, end) part of the source to encode
+    began = time.perf_counter()
+    output_video_path = s2.change_video_resolution(
+        input_video_path,
+        ladder_output_path(output_folder, rung),
+        rung["width"],
+        rung["height"],
+        progress=progress,
+        output_options=rung_output_options(rung),
+        start=window[0],
+        end=window[1]
+    )
+    return output_video_path, time.perf_counter() - began
+
+def ladder_sequential(input_video_path, output_folder, rungs, progress=None, window=(20, 50)):
+    # One ffmpeg process per rung, one after the other: the source is decoded once per rung
+    results = []
 
     #for each resolution, generate a scaled version of the video
-    for res in res_bitrate:
+    for index, rung in enumerate(rungs):
+        #each rung is an equal share of the total progress
+        rung_progress = None
+        if progress:
+            rung_progress = lambda fraction, index=index: progress((index + fraction) / len(rungs))
         try:
             #reuse the function created in the seminar 2
-            output_video_path = s2.change_video_resolution(
-                input_video_path,
-                os.path.join(output_folder, f"video_{res[0]}x{res[1]}.mp4"),
-                res[0],
-                res[1]
-            )
-            generated_video_files.append(output_video_path)
+            results.append((rung, *encode_rung(input_video_path, output_folder, rung, rung_progress, window)))
         except Exception as e:
-            print(f"Error processing resolution {res[0]}x{res[1]}: {e}")
+            print(f"Error processing resolution {rung['width']}x{rung['height']}: {e}")
+    return results
+
+def ladder_split(input_video_path, output_folder, rungs, progress=None, window=(20, 50)):
+    # A single ffmpeg process: the source is decoded once and a split filter feeds one scaler and encoder per rung
+    outputs = [ladder_output_path(output_folder, rung) for rung in rungs]
+    split = ffmpeg.input(input_video_path, **s2.seek_options(*window)).filter_multi_output('split', len(rungs))
+    streams = [
+        ffmpeg.output(split.stream(index).filter('scale', rung["width"], rung["height"]), output, **s2.faststart(output), **rung_output_options(rung))
+        for index, (rung, output) in enumerate(zip(rungs, outputs))
+    ]
+    duration = s2.cut_duration(input_video_path, *window) if progress else 0
+    start = time.perf_counter()
+    pool.run(ffmpeg.merge_outputs(*streams), overwrite_output=True, progress=s2.progress_reporter(progress, duration))
+    #all the rungs share the same process, so they share its time
+    seconds = time.perf_counter() - start
+    return [(rung, output, seconds) for rung, output in zip(rungs, outputs)]
+
+def ladder_parallel(input_video_path, output_folder, rungs, progress=None, window=(20, 50)):
+    # One ffmpeg process per rung, all submitted at once so they run side by side in the ffmpeg pool
+    fractions = [0.0] * len(rungs)
+    def rung_progress(index):
+        if not progress:
+            return None
+        def report(fraction):
+            fractions[index] = fraction
+            progress(sum(fractions) / len(fractions))
+        return report
+
+    results = []
+    with ThreadPoolExecutor(max_workers=len(rungs)) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, encode_rung, input_video_path, output_folder, rung, rung_progress(index), window)
+            for index, rung in enumerate(rungs)
+        ]
+        for rung, future in zip(rungs, futures):
+            try:
+                results.append((rung, *future.result()))
+            except QueueFull:
+                #a busy server is not a broken rung, don't return a ladder with rungs missing
+                raise
+            except Exception as e:
+                print(f"Error processing resolution {rung['width']}x{rung['height']}: {e}")
+    return results
+
+PACKAGING_FORMATS = ['zip', 'hls', 'hls_ts', 'dash']
+
+def package_ladder(input_video_path, output_folder, rungs, packaging, fps, segment_seconds=4, progress=None, window=(20, 50)):
+    # Encodes every rung in one ffmpeg process (decode once, split) straight into a segmented stream:
+    # HLS with fMP4 or TS segments and a master playlist, or DASH with an MPD.
+    # Keyframes are forced at every segment boundary and scene cut keyframes disabled, so the GOPs of all the
+    # rungs line up and players can switch rung at any segment.
+    split = ffmpeg.input(input_video_path, **s2.seek_options(*window)).filter_multi_output('split', len(rungs))
+    streams = [split.stream(index).filter('scale', rung["width"], rung["height"]) for index, rung in enumerate(rungs)]
+
+    gop = max(int(round(fps * segment_seconds)), 1)
+    options = {
+        "g": gop,
+        "keyint_min": gop,
+        "sc_threshold": 0,
+        "force_key_frames": f"expr:gte(t,n_forced*{segment_seconds})",
+    }
+    for index, rung in enumerate(rungs):
+        for name, value in rung_output_options(rung).items():
+            #per stream options: vcodec -> c:v:0, b:v -> b:v:0, maxrate -> maxrate:v:0 ...
+            name = "c" if name == "vcodec" else name.removesuffix(":v")
+            options[f"{name}:v:{index}"] = value
+
+    if packaging == 'dash':
+        manifest = "manifest.mpd"
+        options.update({
+            "f": "dash",
+            "seg_duration": segment_seconds,
+            "use_template": 1,
+            "use_timeline": 1,
+            "adaptation_sets": "id=0,streams=v",
+        })
+        output = os.path.join(output_folder, manifest)
+    else:
+        manifest = "master.m3u8"
+        fmp4 = packaging == 'hls'
+        for index in range(len(rungs)):
+            os.makedirs(os.path.join(output_folder, f"v{index}"), exist_ok=True)
+        options.update({
+            "f": "hls",
+            "hls_time": segment_seconds,
+            "hls_playlist_type": "vod",
+            "hls_segment_type": "fmp4" if fmp4 else "mpegts",
+            "hls_segment_filename": os.path.join(output_folder, "v%v", "segment_%05d." + ("m4s" if fmp4 else "ts")),
+            "master_pl_name": manifest,
+            "var_stream_map": " ".join(f"v:{index}" for index in range(len(rungs))),
+        })
+        output = os.path.join(output_folder, "v%v", "index.m3u8")
+
+    duration = s2.cut_duration(input_video_path, *window) if progress else 0
+    pool.run(ffmpeg.output(*streams, output, **options), overwrite_output=True, progress=s2.progress_reporter(progress, duration))
+    return os.path.join(output_folder, manifest)
+
+def ladder_report(results, duration, mode):
+    # Size, real bitrate and encode time of every rung, to tune the ladder for bandwidth cost
+    rungs = []
+    for rung, output_video_path, seconds in results:
+        size = os.path.getsize(output_video_path)
+        rungs.append({
+            **rung,
+            "file": os.path.basename(output_video_path),
+            "size_bytes": size,
+            "actual_bitrate_kbps": round(size * 8 / duration / 1000, 1) if duration > 0 else None,
+            "encode_seconds": round(seconds, 3),
+        })
+    return {"mode": mode, "duration_seconds": duration, "rungs": rungs}
+
+def source_ladder(input_video_path, ladder=None):
+    # Rungs of the ladder that fit the source, and the source metadata
+    rungs = load_ladder(ladder)
+    metadata = probe_video(input_video_path)
+    if metadata.video is None:
+        raise ValueError("The input has no video stream")
+    return prune_ladder(rungs, metadata.video.width, metadata.video.height), metadata
+
+def encoding_ladder_files(input_video_path, output_folder, progress=None, mode='sequential', ladder=None, window=(20, 50)):
+    # Encodes the rungs as MP4 files plus a ladder.json report and returns their paths
+    if mode not in LADDER_MODES:
+        raise ValueError(f"Invalid ladder mode, choose: {', '.join(LADDER_MODES)}")
+    rungs, metadata = source_ladder(input_video_path, ladder)
+    duration = s2.cut_duration(input_video_path, *window)
+
+    #encode every rung with the chosen strategy
+    if mode == 'split':
+        try:
+            results = ladder_split(input_video_path, output_folder, rungs, progress, window)
+        except ffmpeg.Error as e:
+            #a single failing rung stops the whole graph, retry each rung on its own
+            print(f"Error in the single decode ladder, falling back to sequential: {e}")
+            results = ladder_sequential(input_video_path, output_folder, rungs, progress, window)
+    elif mode == 'parallel':
+        results = ladder_parallel(input_video_path, output_folder, rungs, progress, window)
+    else:
+        results = ladder_sequential(input_video_path, output_folder, rungs, progress, window)
+
+    report_path = os.path.join(output_folder, "ladder.json")
+    with open(report_path, "w") as report:
+        json.dump(ladder_report(results, duration, mode), report, indent=2)
+    return [video_file for _, video_file, _ in results] + [report_path]
+
+class ZipStreamBuffer:
+    # Write only sink for zipfile, the generator takes what was written after every chunk
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_zip(files, chunk_size=1024 * 1024):
+    # Yields a zip of the files while reading them, without building the archive on disk.
+    # Videos are already compressed, so they are stored (ZIP_STORED) instead of deflated.
+    buffer = ZipStreamBuffer()
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as zip:
+        for path in files:
+            info = zipfile.ZipInfo.from_file(path, arcname=os.path.basename(path))
+            info.compress_type = zipfile.ZIP_STORED
+            with open(path, "rb") as source, zip.open(info, 'w', force_zip64=info.file_size >= zipfile.ZIP64_LIMIT) as destination:
+                while chunk := source.read(chunk_size):
+                    destination.write(chunk)
+                    yield buffer.take()
+            yield buffer.take()
+    #central directory
+    yield buffer.take()
+
+def encoding_ladder(input_video_path, output_folder, progress=None, mode='sequential', ladder=None, packaging='zip', window=(20, 50)):
+    # ladder is a list of rungs or a JSON string (see load_ladder), by default the configured ladder.
+    # The rungs above the source resolution are skipped, and a ladder.json report is added to the zip.
+    # With packaging hls, hls_ts or dash the rungs are segmented for streaming instead of zipped (mode is not
+    # used, it is always a single process) and the path of the master playlist / MPD is returned.
+    if packaging not in PACKAGING_FORMATS:
+        raise ValueError(f"Invalid packaging, choose: {', '.join(PACKAGING_FORMATS)}")
+    if packaging != 'zip':
+        rungs, metadata = source_ladder(input_video_path, ladder)
+        return package_ladder(input_video_path, output_folder, rungs, packaging, metadata.video.frame_rate or 25, progress=progress, window=window)
+
+    files = encoding_ladder_files(input_video_path, output_folder, progress, mode, ladder, window)
     
-    # Because we cannot return multiple files, we will compress them into a zip file to output
+    # Because we cannot return multiple files, we will put them into a zip file to output
     zip_path = os.path.join(output_folder, "encoding_ladder.zip")
 
-    with zipfile.ZipFile(zip_path, 'w') as zip:
-        for video_file in generated_video_files:
-            zip.write(video_file, arcname=os.path.basename(video_file))
+    with open(zip_path, "wb") as zip:
+        for chunk in stream_zip(files):
+            zip.write(chunk)
     
     return zip_path
-    
-
@@ -0,0 +1,142 @@
+# Cached metadata of the input videos
+# ffprobe runs once per input: the parsed result is kept in memory keyed by the file identity (path, inode, size and
+# mtime) and, for uploads, by the hash of their bytes, so every function that needs the duration, the resolution or
+# the tracks of the same file (info endpoints, cuts, ladder) shares one probe instead of starting a process each.
+import asyncio
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from .ffmpeg_pool import pool
+
+PROBE_ARGS = ["-show_format", "-show_streams", "-of", "json"]
+
+def parse_fraction(text):
+    # "30000/1001" -> 29.97, without eval. Returns 0.0 for missing or undefined rates like "0/0"
+    try:
+        numerator, _, denominator = str(text).partition("/")
+        numerator = float(numerator)
+        denominator = float(denominator) if denominator else 1.0
+    except ValueError:
+        return 0.0
+    return numerator / denominator if denominator else 0.0
+
+def _int(value, default=0):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+def _float(value, default=0.0):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+class StreamInfo:
+    __slots__ = ("index", "codec_type", "codec_name", "width", "height", "pix_fmt", "frame_rate", "frames",
+                 "bit_rate", "sample_rate", "channels")
+
+    def __init__(self, stream):
+        self.index = _int(stream.get("index"))
+        self.codec_type = stream.get("codec_type", "unknown")
+        self.codec_name = stream.get("codec_name")
+        self.width = _int(stream.get("width"))
+        self.height = _int(stream.get("height"))
+        self.pix_fmt = stream.get("pix_fmt")
+        self.frame_rate = parse_fraction(stream.get("r_frame_rate", "0/1"))
+        self.frames = _int(stream.get("nb_frames"))
+        self.bit_rate = _int(stream.get("bit_rate"))
+        self.sample_rate = _int(stream.get("sample_rate"))
+        self.channels = _int(stream.get("channels"))
+
+class VideoMetadata:
+    __slots__ = ("duration", "start_time", "bit_rate", "size", "format_name", "streams", "video", "raw")
+
+    def __init__(self, probe):
+        format_info = probe.get("format", {})
+        self.duration = _float(format_info.get("duration"))
+        self.start_time = _float(format_info.get("start_time"))
+        self.bit_rate = _int(format_info.get("bit_rate"))
+        self.size = _int(format_info.get("size"))
+        self.format_name = format_info.get("format_name")
+        self.streams = tuple(StreamInfo(stream) for stream in probe.get("streams", []))
+        #first video stream, the one every function works on
+        self.video = next((stream for stream in self.streams if stream.codec_type == "video"), None)
+        self.raw = probe
+
+    def count(self, codec_type):
+        return sum(1 for stream in self.streams if stream.codec_type == codec_type)
+
+class ProbeCache:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def file_key(path):
+        stat = os.stat(path)
+        return ("file", os.path.realpath(path), stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def get(self, keys):
+        with self._lock:
+            for key in keys:
+                metadata = self._entries.get(key)
+                if metadata is not None:
+                    #remember the other keys too, e.g. the path of a new upload of an already probed file
+                    for other in keys:
+                        self._entries[other] = metadata
+                        self._entries.move_to_end(other)
+                    self.hits += 1
+                    return metadata
+            self.misses += 1
+        return None
+
+    def put(self, keys, metadata):
+        with self._lock:
+            for key in keys:
+                self._entries[key] = metadata
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+probes = ProbeCache()
+
+def _keys(path, digest):
+    keys = [probes.file_key(path)]
+    if digest:
+        keys.append(("sha256", digest))
+    return keys
+
+def probe_video(path, digest=None):
+    # VideoMetadata of path, probing it through the ffmpeg pool only the first time
+    keys = _keys(path, digest)
+    metadata = probes.get(keys)
+    if metadata is None:
+        metadata = VideoMetadata(pool.probe(str(path)))
+        probes.put(keys, metadata)
+    return metadata
+
+async def probe_video_async(path, digest=None):
+    # Same as probe_video for the endpoints: ffprobe runs as an asyncio subprocess, no thread waits for it
+    keys = _keys(path, digest)
+    metadata = probes.get(keys)
+    if metadata is not None:
+        return metadata
+    process = await asyncio.create_subprocess_exec(
+        "ffprobe", *PROBE_ARGS, str(path), stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+    )
+    stdout, stderr = await process.communicate()
+    if process.returncode != 0:
+        raise ValueError(f"ffprobe could not read the file: {stderr.decode('utf-8', 'replace').strip()}")
+    metadata = VideoMetadata(json.loads(stdout.decode("utf-8")))
+    probes.put(keys, metadata)
+    return metadata
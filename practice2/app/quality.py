@@ -0,0 +1,168 @@
+# Objective quality (PSNR and SSIM) of a processed video against its source
+# One ffmpeg process decodes both videos, scales the distorted one to the size of the reference and stacks each pair
+# of frames (reference on top) into a single raw yuv444p frame on its stdout. The frames are read from the pipe into
+# one reused buffer and scored with vectorized NumPy/SciPy in reused float32 work buffers, so the memory used
+# depends on the resolution only, never on the length of the videos.
+import math
+
+import numpy as np
+from scipy import ndimage
+
+from .ffmpeg_pool import pool
+from .probe import probe_video
+from . import s2_functions as s2
+
+PLANES = ("y", "u", "v")
+# PSNR of identical frames, instead of infinity (which JSON can't hold)
+MAX_PSNR = 100.0
+# SSIM constants of Wang et al. for 8 bit samples, 11x11 gaussian window of sigma 1.5
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+SSIM_SIGMA = 1.5
+SSIM_TRUNCATE = 3.5
+
+def psnr(mse):
+    return MAX_PSNR if mse <= 0 else min(10 * math.log10(255 ** 2 / mse), MAX_PSNR)
+
+class FrameScorer:
+    # Per frame PSNR of every plane and SSIM of the luma of frames of width x height, with its buffers allocated once
+    def __init__(self, width, height):
+        self.pixels = width * height
+        self.x = np.empty((height, width), np.float32)
+        self.y = np.empty((height, width), np.float32)
+        self.mu_x = np.empty((height, width), np.float32)
+        self.mu_y = np.empty((height, width), np.float32)
+        self.sigma_xx = np.empty((height, width), np.float32)
+        self.sigma_xy = np.empty((height, width), np.float32)
+        self.tmp = np.empty((height, width), np.float32)
+
+    def mse(self, reference, distorted):
+        # Mean squared error of one plane, the dot product avoids a buffer for the squares
+        np.subtract(distorted, reference, out=self.tmp, dtype=np.float32)
+        flat = self.tmp.ravel()
+        return float(np.dot(flat, flat)) / self.pixels
+
+    def blur(self, values, out):
+        ndimage.gaussian_filter(values, SSIM_SIGMA, output=out, mode="reflect", truncate=SSIM_TRUNCATE)
+
+    def ssim(self, reference, distorted):
+        x, y, mu_x, mu_y, sigma_xx, sigma_xy, tmp = self.x, self.y, self.mu_x, self.mu_y, self.sigma_xx, self.sigma_xy, self.tmp
+        x[...] = reference
+        y[...] = distorted
+        self.blur(x, mu_x)
+        self.blur(y, mu_y)
+        np.multiply(x, y, out=tmp)
+        self.blur(tmp, sigma_xy)
+        np.multiply(x, x, out=tmp)
+        self.blur(tmp, sigma_xx)
+        #x is not needed anymore, it holds the blurred y squared
+        np.multiply(y, y, out=tmp)
+        self.blur(tmp, x)
+        sigma_yy = x
+
+        #variances and covariance
+        np.multiply(mu_x, mu_y, out=tmp)
+        sigma_xy -= tmp
+        np.multiply(mu_x, mu_x, out=y)
+        sigma_xx -= y
+        np.multiply(mu_y, mu_y, out=y)
+        sigma_yy -= y
+
+        #numerator (2 mu_x mu_y + C1)(2 sigma_xy + C2) in tmp, denominator in mu_x
+        tmp *= 2
+        tmp += SSIM_C1
+        sigma_xy *= 2
+        sigma_xy += SSIM_C2
+        tmp *= sigma_xy
+        np.multiply(mu_x, mu_x, out=mu_x)
+        mu_x += y
+        mu_x += SSIM_C1
+        sigma_xx += sigma_yy
+        sigma_xx += SSIM_C2
+        mu_x *= sigma_xx
+        tmp /= mu_x
+        return float(tmp.mean())
+
+    def score(self, reference, distorted):
+        # (mse of y, u and v, ssim) of one pair of yuv444p frames, arrays of shape (3, height, width)
+        return [self.mse(reference[plane], distorted[plane]) for plane in range(3)], self.ssim(reference[0], distorted[0])
+
+def read_frames(pipe, width, height, on_frame):
+    # Reads stacked (reference over distorted) yuv444p frames from pipe into one buffer, calling
+    # on_frame(reference, distorted) with views of it. Returns the number of frames
+    buffer = bytearray(3 * 2 * width * height)
+    view = memoryview(buffer)
+    frame = np.frombuffer(buffer, np.uint8).reshape(3, 2 * height, width)
+    reference, distorted = frame[:, :height], frame[:, height:]
+    count = 0
+    while True:
+        filled = 0
+        while filled < len(buffer):
+            read = pipe.readinto(view[filled:])
+            if not read:
+                break
+            filled += read
+        if filled < len(buffer):
+            return count
+        on_frame(reference, distorted)
+        count += 1
+
+def compare_videos(reference_path, distorted_path, start=0.0, end=None, per_frame=True):
+    # PSNR (y, u, v and all the planes) and luma SSIM of distorted against the part of reference between
+    # start and end. The distorted video is scaled to the reference size and compared frame by frame from its start.
+    video = probe_video(reference_path).video
+    if video is None or not video.width or not video.height:
+        raise ValueError("The reference has no video stream")
+    width, height = video.width, video.height
+    graph = (
+        f"[0:v]format=yuv444p[reference];"
+        f"[1:v]scale={width}:{height}:flags=bicubic,format=yuv444p[distorted];"
+        f"[reference][distorted]vstack=shortest=1"
+    )
+    seek = []
+    for name, value in s2.seek_options(start, end).items():
+        seek += [f"-{name}", str(value)]
+    args = [
+        "ffmpeg", "-nostdin", "-v", "error", *seek, "-i", str(reference_path), "-i", str(distorted_path),
+        "-filter_complex", graph, "-f", "rawvideo", "-pix_fmt", "yuv444p", "pipe:1",
+    ]
+
+    #running totals for the summary, the scores of every frame are only kept when they are returned
+    scorer = FrameScorer(width, height)
+    totals = {"mse": np.zeros(3), "ssim": 0.0, "psnr_min": MAX_PSNR, "ssim_min": 1.0}
+    frames = [] if per_frame else None
+    def on_frame(reference, distorted):
+        errors, score = scorer.score(reference, distorted)
+        frame_psnr = psnr(sum(errors) / 3)
+        totals["mse"] += errors
+        totals["ssim"] += score
+        totals["psnr_min"] = min(totals["psnr_min"], frame_psnr)
+        totals["ssim_min"] = min(totals["ssim_min"], score)
+        if frames is not None:
+            frames.append({
+                "frame": len(frames), **{f"psnr_{plane}": psnr(value) for plane, value in zip(PLANES, errors)},
+                "psnr": frame_psnr, "ssim": score,
+            })
+
+    def reader(pipe):
+        return read_frames(pipe, width, height, on_frame)
+    count, _ = pool.submit_args(args, capture_stderr=True, reader=reader).result()
+    if not count:
+        raise ValueError("No frames could be compared")
+
+    #aggregate PSNR from the mean squared error of all the frames, like ffmpeg's psnr filter
+    mean_mse = totals["mse"] / count
+    summary = {
+        "frames": count,
+        "width": width,
+        "height": height,
+        **{f"psnr_{plane}": psnr(float(value)) for plane, value in zip(PLANES, mean_mse)},
+        "psnr": psnr(float(mean_mse.mean())),
+        "psnr_min": totals["psnr_min"],
+        "ssim": totals["ssim"] / count,
+        "ssim_min": totals["ssim_min"],
+    }
+    result = {"summary": summary}
+    if per_frame:
+        result["frames"] = frames
+    return result
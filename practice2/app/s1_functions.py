@@ -1,9 +1,61 @@
 import ffmpeg
+from .ffmpeg_pool import pool
 import numpy as np
 from PIL import Image
 import os
 from scipy.fftpack import dct, idct
 import matplotlib.pyplot as plt
+from functools import lru_cache
+from collections import namedtuple
+
+# (Kr, Kb) luma coefficients of each standard, the rest of the matrix derives from them
+YUV_COEFFICIENTS = {
+    'bt601': (0.299, 0.114),
+    'bt709': (0.2126, 0.0722),
+    'bt2020': (0.2627, 0.0593),
+}
+
+@lru_cache(maxsize=None)
+def yuv_matrix(standard='bt601', full_range=True):
+    # Returns the 3x3 RGB->YCbCr matrix and the offset vector for 8 bit samples
+    if standard not in YUV_COEFFICIENTS:
+        raise ValueError(f"Invalid standard, choose: {', '.join(YUV_COEFFICIENTS)}")
+    kr, kb = YUV_COEFFICIENTS[standard]
+    kg = 1.0 - kr - kb
+    matrix = np.array([
+        [kr, kg, kb],
+        [-0.5 * kr / (1 - kb), -0.5 * kg / (1 - kb), 0.5],
+        [0.5, -0.5 * kg / (1 - kr), -0.5 * kb / (1 - kr)],
+    ])
+    offset = np.array([0.0, 128.0, 128.0])
+    if not full_range:
+        #limited (tv) range: Y in [16, 235], U and V in [16, 240]
+        matrix = matrix * np.array([[219 / 255], [224 / 255], [224 / 255]])
+        offset = np.array([16.0, 128.0, 128.0])
+    matrix = matrix.astype(np.float32)
+    offset = offset.astype(np.float32)
+    matrix.flags.writeable = False
+    offset.flags.writeable = False
+    return matrix, offset
+
+@lru_cache(maxsize=None)
+def rgb_matrix(standard='bt601', full_range=True):
+    # Inverse of yuv_matrix, the offset is folded into a bias so that rgb = yuv @ M.T - bias
+    matrix, offset = yuv_matrix(standard, full_range)
+    inverse = np.linalg.inv(matrix.astype(np.float64))
+    bias = (inverse @ offset.astype(np.float64)).astype(np.float32)
+    inverse = inverse.astype(np.float32)
+    inverse.flags.writeable = False
+    bias.flags.writeable = False
+    return inverse, bias
+
+def _check_frame(frame, out):
+    frame = np.asarray(frame)
+    if frame.ndim < 3 or frame.shape[-1] != 3:
+        raise ValueError("Frame must have shape HxWx3 or NxHxWx3")
+    if out is not None and (out.shape != frame.shape or out.dtype not in (np.float32, np.float64)):
+        raise ValueError("Output buffer must be a float array with the same shape as the frame")
+    return frame
 
 class traslator:
     def rgb_to_yuv(self, r, g, b):                            #Use the formulas to convert RGB to YUV
@@ -18,40 +70,64 @@ class traslator:
         b = y + 2.03211 * u
         return r, g, b
 
+    def rgb_to_yuv_frame(self, frame, standard='bt601', full_range=True, out=None):
+        # Converts a whole HxWx3 frame (or NxHxWx3 batch) with a single matrix multiply
+        frame = _check_frame(frame, out)
+        matrix, offset = yuv_matrix(standard, full_range)
+        out = np.matmul(frame, matrix.T, out=out, dtype=out.dtype if out is not None else np.float32)
+        out += offset
+        return out
+
+    def yuv_to_rgb_frame(self, frame, standard='bt601', full_range=True, out=None):
+        # Inverse of rgb_to_yuv_frame, same shapes and buffer rules
+        frame = _check_frame(frame, out)
+        inverse, bias = rgb_matrix(standard, full_range)
+        out = np.matmul(frame, inverse.T, out=out, dtype=out.dtype if out is not None else np.float32)
+        out -= bias
+        return out
+
 def resize_image(input_image, output_image, width = -1, height = -1):   #Resize image using ffmpeg
     stream = ffmpeg.input(input_image)
     stream = ffmpeg.filter(stream, 'scale', width, height)
     stream = ffmpeg.output(stream, output_image)
-    ffmpeg.run(stream)
+    pool.run(stream)
+
+@lru_cache(maxsize=64)
+def serpentine_indices(height, width):
+    # Flat indices of the serpentine (zig-zag) order of a height x width grid, computed once per shape.
+    # Diagonals are visited in order, odd ones going up-right and even ones going down-left.
+    y, x = np.indices((height, width))
+    diagonal = (y + x).ravel()
+    x = x.ravel()
+    along = np.where(diagonal % 2 == 1, x, -x)
+    order = np.lexsort((along, diagonal))
+    order.flags.writeable = False
+    return order
+
+def serpentine_scan(blocks):
+    # Reads the last two axes in serpentine order, works for a single (H, W) matrix or (N, 8, 8) blocks
+    blocks = np.asarray(blocks)
+    height, width = blocks.shape[-2:]
+    order = serpentine_indices(height, width)
+    return blocks.reshape(blocks.shape[:-2] + (height * width,))[..., order]
+
+def serpentine_unscan(coefficients, height, width):
+    # Inverse of serpentine_scan: scatters (..., H*W) coefficients back into (..., H, W)
+    coefficients = np.asarray(coefficients)
+    order = serpentine_indices(height, width)
+    output = np.empty(coefficients.shape[:-1] + (height * width,), dtype=coefficients.dtype)
+    output[..., order] = coefficients
+    return output.reshape(coefficients.shape[:-1] + (height, width))
 
 def serpentine(input_image):
     with Image.open(input_image) as img:
         pixels = np.array(img)
         height, width = pixels.shape[:2]
 
+        #gather every pixel at once with the cached index table
         output_pixels = np.zeros((height * width, 3))
-        index = 0
-        
-        for i in range(height + width - 1):
-            if i % 2 == 1:  # Odd diagonals (up-right)
-                x = 0 if i < height else i - height + 1
-                y = i if i < height else height - 1
-                while x < width and y >= 0:
-                    if index < len(output_pixels):
-                        output_pixels[index] = pixels[y, x]
-                        index += 1
-                    x += 1
-                    y -= 1
-            else:  # Even diagonals (down-left)
-                x = i if i < width else width - 1
-                y = 0 if i < width else i - width + 1
-                while x >= 0 and y < height:
-                    if index < len(output_pixels):
-                        output_pixels[index] = pixels[y, x]
-                        index += 1
-                    x -= 1
-                    y += 1
-        
+        output_pixels[:] = pixels.reshape(height * width, -1)[serpentine_indices(height, width)]
+
         return output_pixels
         
 
@@ -59,7 +135,7 @@ def to_black_white(input_image_path, output_image_path):
     stream = ffmpeg.input(input_image_path)
     stream = ffmpeg.filter(stream, 'format', 'gray')
     stream = ffmpeg.output(stream, output_image_path)
-    ffmpeg.run(stream)
+    pool.run(stream)
     return output_image_path
 
 def run_length_encoding(byte_stream):
@@ -87,6 +163,134 @@ def run_length_encoding(byte_stream):
     return encoded_stream
     '''
     
+RLE_MAGIC = b"RLE1"
+# Largest output the decoder accepts, a few bytes can otherwise declare runs of terabytes
+RLE_MAX_DECODED_BYTES = int(os.environ.get("SCAV_RLE_MAX_DECODED_BYTES", 256 * 1024 ** 2))
+
+def rle_encode(data):
+    # Vectorized run length encoding: runs start where a byte differs from the previous one
+    data = np.frombuffer(data, dtype=np.uint8) if isinstance(data, (bytes, bytearray, memoryview)) else np.asarray(data, dtype=np.uint8).ravel()
+    if data.size == 0:
+        return np.empty(0, dtype=np.uint8), np.empty(0, dtype=np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(data[1:] != data[:-1]) + 1))
+    lengths = np.diff(np.append(starts, data.size))
+    return data[starts], lengths
+
+def check_decoded_size(lengths, max_bytes=RLE_MAX_DECODED_BYTES):
+    # Raises ValueError when the runs expand to more than max_bytes, before anything is allocated.
+    # The max is checked first so the sum of a few huge lengths can't overflow int64
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if lengths.size and (lengths.max() > max_bytes or int(lengths.sum()) > max_bytes):
+        raise ValueError(f"The decoded stream would be bigger than the limit of {max_bytes} bytes")
+
+def rle_decode(values, lengths, max_bytes=RLE_MAX_DECODED_BYTES):
+    check_decoded_size(lengths, max_bytes)
+    return np.repeat(np.asarray(values, dtype=np.uint8), lengths)
+
+def _varint_encode(numbers):
+    # LEB128 varints, 7 bits per byte, high bit set on every byte except the last one
+    numbers = np.asarray(numbers, dtype=np.uint64)
+    n_bytes = np.ones(numbers.size, dtype=np.int64)
+    rest = numbers >> np.uint64(7)
+    while rest.any():
+        n_bytes += rest > 0
+        rest >>= np.uint64(7)
+    ends = np.cumsum(n_bytes)
+    starts = ends - n_bytes
+    output = np.empty(int(ends[-1]) if numbers.size else 0, dtype=np.uint8)
+    for k in range(int(n_bytes.max()) if numbers.size else 0):
+        mask = n_bytes > k
+        chunk = (numbers[mask] >> np.uint64(7 * k)) & np.uint64(0x7F)
+        more = (n_bytes[mask] > k + 1).astype(np.uint64) << np.uint64(7)
+        output[starts[mask] + k] = chunk | more
+    return output
+
+def _varint_decode(buffer):
+    buffer = np.asarray(buffer, dtype=np.uint8)
+    ends = np.flatnonzero(buffer < 0x80)
+    if ends.size == 0:
+        return np.empty(0, dtype=np.int64)
+    if ends[-1] != buffer.size - 1:
+        raise ValueError("Truncated varint stream")
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    #9 bytes hold 63 bits, longer varints would shift past 64 bits
+    if (ends - starts + 1).max() > 9:
+        raise ValueError("Corrupted varint stream, a varint is longer than 9 bytes")
+    position = np.arange(buffer.size) - np.repeat(starts, ends - starts + 1)
+    payload = (buffer & 0x7F).astype(np.uint64) << (7 * position).astype(np.uint64)
+    return np.add.reduceat(payload, starts).astype(np.int64)
+
+def rle_to_bytes(values, lengths):
+    # Binary format: magic, number of runs (uint64 little endian), one byte per run value, varint run lengths
+    header = RLE_MAGIC + np.uint64(len(values)).astype('<u8').tobytes()
+    return header + np.asarray(values, dtype=np.uint8).tobytes() + _varint_encode(lengths).tobytes()
+
+def rle_from_bytes(payload, max_bytes=RLE_MAX_DECODED_BYTES):
+    # (values, lengths) of a stream written by rle_to_bytes. Raises ValueError when it is corrupted or would
+    # decode to more than max_bytes
+    payload = np.frombuffer(payload, dtype=np.uint8)
+    #magic and number of runs
+    if payload.size < 12:
+        raise ValueError("Truncated run length encoded stream")
+    if payload[:4].tobytes() != RLE_MAGIC:
+        raise ValueError("Not a run length encoded stream")
+    n_runs = int(payload[4:12].view('<u8')[0])
+    values = payload[12:12 + n_runs]
+    lengths = _varint_decode(payload[12 + n_runs:])
+    if values.size != n_runs or lengths.size != n_runs:
+        raise ValueError("Corrupted run length encoded stream")
+    check_decoded_size(lengths, max_bytes)
+    return values, lengths
+
+# Quantization tables of the JPEG standard (Annex K), for quality 50
+JPEG_QUANTIZATION_TABLES = {
+    'luma': np.array([
+        [16, 11, 10, 16, 24, 40, 51, 61],
+        [12, 12, 14, 19, 26, 58, 60, 55],
+        [14, 13, 16, 24, 40, 57, 69, 56],
+        [14, 17, 22, 29, 51, 87, 80, 62],
+        [18, 22, 37, 56, 68, 109, 103, 77],
+        [24, 35, 55, 64, 81, 104, 113, 92],
+        [49, 64, 78, 87, 103, 121, 120, 101],
+        [72, 92, 95, 98, 112, 100, 103, 99],
+    ]),
+    'chroma': np.array([
+        [17, 18, 24, 47, 99, 99, 99, 99],
+        [18, 21, 26, 66, 99, 99, 99, 99],
+        [24, 26, 56, 99, 99, 99, 99, 99],
+        [47, 66, 99, 99, 99, 99, 99, 99],
+        [99, 99, 99, 99, 99, 99, 99, 99],
+        [99, 99, 99, 99, 99, 99, 99, 99],
+        [99, 99, 99, 99, 99, 99, 99, 99],
+        [99, 99, 99, 99, 99, 99, 99, 99],
+    ]),
+}
+
+def quantization_table(quality=50, table='luma'):
+    # Scales a base table with the IJG quality factor (1 worst, 100 best)
+    if not 1 <= quality <= 100:
+        raise ValueError("Quality must be between 1 and 100")
+    base = JPEG_QUANTIZATION_TABLES[table] if isinstance(table, str) else np.asarray(table)
+    scale = 5000 / quality if quality < 50 else 200 - 2 * quality
+    return np.clip((base * scale + 50) // 100, 1, 255).astype(np.float32)
+
+def to_blocks(frame, size=8):
+    # Splits a (H, W) plane into (N, size, size) tiles, padding the borders by repeating the edge
+    height, width = frame.shape
+    pad_h = -height % size
+    pad_w = -width % size
+    if pad_h or pad_w:
+        frame = np.pad(frame, ((0, pad_h), (0, pad_w)), mode='edge')
+    rows, cols = frame.shape[0] // size, frame.shape[1] // size
+    return frame.reshape(rows, size, cols, size).swapaxes(1, 2).reshape(-1, size, size)
+
+def from_blocks(blocks, height, width):
+    # Inverse of to_blocks, crops the padding away
+    size = blocks.shape[-1]
+    rows, cols = -(-height // size), -(-width // size)
+    frame = blocks.reshape(rows, cols, size, size).swapaxes(1, 2).reshape(rows * size, cols * size)
+    return frame[:height, :width]
+
 class DCTEncoder:
     def encode(self, input):
         return dct(dct(input.T, norm='ortho').T, norm='ortho')
@@ -94,6 +298,32 @@ class DCTEncoder:
     def decode(self, input):
         return idct(idct(input.T, norm='ortho').T, norm='ortho') 
 
+    def encode_blocks(self, frame, quality=50, table='luma'):
+        # Codec style DCT: 8x8 tiles, level shift, batched 2D DCT over the last two axes and quantization.
+        # With quality=None the float coefficients are returned without quantizing.
+        blocks = to_blocks(np.asarray(frame, dtype=np.float32) - 128)
+        coefficients = dct(dct(blocks, axis=-1, norm='ortho'), axis=-2, norm='ortho')
+        if quality is None:
+            return coefficients
+        return np.rint(coefficients / quantization_table(quality, table)).astype(np.int16)
+
+    def decode_blocks(self, coefficients, height, width, quality=50, table='luma'):
+        coefficients = np.asarray(coefficients, dtype=np.float32)
+        if quality is not None:
+            coefficients = coefficients * quantization_table(quality, table)
+        blocks = idct(idct(coefficients, axis=-2, norm='ortho'), axis=-1, norm='ortho')
+        return from_blocks(blocks, height, width) + 128
+
+DWTPyramid = namedtuple('DWTPyramid', ['buffer', 'shape', 'levels'])
+
+class DWTBands(tuple):
+    # (LL, LH, HL, HH) returned by DWTEncoder.encode, it unpacks like a plain tuple. shape is the size of the
+    # source image: the bands of an odd sized image cover its symmetric extension, decode crops back to it
+    def __new__(cls, bands, shape):
+        bands = super().__new__(cls, bands)
+        bands.shape = shape
+        return bands
+
 class DWTEncoder:
 
     def lowpassfilter(self, input_1, input_2):
@@ -101,39 +331,62 @@ class DWTEncoder:
     def highpassfilter(self, input_1, input_2):
         return (input_1 - input_2) / 2
 
-    def encode(self, input):
-        input = input.astype(float)
-        high, width = input.shape
-        
-        #if the dimensions are not even, make them even by a tiny crop as an easy way.
-        if high % 2 != 0:
-            high -= 1
-            input = input[:high, :]
-        if width % 2 != 0:
-            width -= 1
-            input = input[:, :width]
-        
-        #Divide the image in odd and even columns to apply the horitzontal filters
-        even_columns = input[:, 0:width:2]
-        odd_columns = input[:, 1:width:2]
+    def lift(self, even, odd):
+        # Haar lifting step done in place on two views: even becomes the lowpass, odd the highpass
+        np.subtract(even, odd, out=odd)
+        odd *= 0.5
+        even -= odd
 
-        L = self.lowpassfilter(even_columns, odd_columns)
-        H = self.highpassfilter(even_columns, odd_columns)
+    def unlift(self, even, odd):
+        # Exact inverse of lift
+        even += odd
+        odd *= -2
+        odd += even
 
-        #Now apply the vertical filters
-        #First we have to divide L and H in odd and even rows as before
-        L_even_rows = L[0:high:2, :]
-        L_odd_rows = L[1:high:2, :]
-        H_even_rows = H[0:high:2, :]
-        H_odd_rows = H[1:high:2, :]
+    def encode_pyramid(self, input, levels=3):
+        # N level wavelet pyramid of a (H, W) image or a (N, H, W) batch, computed in place on one float32 buffer.
+        # Odd sizes are handled with a symmetric extension up to a multiple of 2**levels, which decode crops away.
+        # The subbands stay interleaved in the buffer (level k uses a stride of 2**k), use subbands() to read them.
+        input = np.asarray(input)
+        high, width = input.shape[-2:]
+        block = 2 ** levels
+        pad = [(0, 0)] * (input.ndim - 2) + [(0, -high % block), (0, -width % block)]
+        buffer = np.pad(input.astype(np.float32), pad, mode='symmetric')
 
-        LL = self.lowpassfilter(L_even_rows, L_odd_rows)
-        LH = self.highpassfilter(L_even_rows, L_odd_rows)
+        for level in range(levels):
+            step = 2 ** level
+            #horizontal filters on the lowpass samples of the previous level, then the vertical ones
+            self.lift(buffer[..., ::step, ::2 * step], buffer[..., ::step, step::2 * step])
+            self.lift(buffer[..., ::2 * step, ::step], buffer[..., step::2 * step, ::step])
 
-        HL = self.lowpassfilter(H_even_rows, H_odd_rows)
-        HH = self.highpassfilter(H_even_rows, H_odd_rows)
+        return DWTPyramid(buffer, (high, width), levels)
 
+    def subbands(self, pyramid, level=None):
+        # Views of LL, LH, HL, HH of a level (1 is the finest), by default the coarsest one
+        level = pyramid.levels if level is None else level
+        step = 2 ** (level - 1)
+        buffer = pyramid.buffer
+        LL = buffer[..., ::2 * step, ::2 * step]
+        LH = buffer[..., step::2 * step, ::2 * step]
+        HL = buffer[..., ::2 * step, step::2 * step]
+        HH = buffer[..., step::2 * step, step::2 * step]
         return LL, LH, HL, HH
+
+    def decode_pyramid(self, pyramid, in_place=False):
+        buffer = pyramid.buffer if in_place else pyramid.buffer.copy()
+        for level in reversed(range(pyramid.levels)):
+            step = 2 ** level
+            self.unlift(buffer[..., ::2 * step, ::step], buffer[..., step::2 * step, ::step])
+            self.unlift(buffer[..., ::step, ::2 * step], buffer[..., ::step, step::2 * step])
+        high, width = pyramid.shape
+        return buffer[..., :high, :width]
+
+    def encode(self, input):
+        #Single level of the lifting pyramid. Odd dimensions are extended symmetrically instead of cropped,
+        #for even dimensions the result is the same as filtering even and odd columns and rows separately.
+        #The bands are float32 (the input is converted), and remember the source size so decode can crop to it
+        pyramid = self.encode_pyramid(input, levels=1)
+        return DWTBands((np.ascontiguousarray(band) for band in self.subbands(pyramid)), pyramid.shape)
     
 
     def visualize_dwt(self, LL, LH, HL, HH):
@@ -164,25 +417,33 @@ class DWTEncoder:
         return LL, LH, HL, HH
     
 
-    def decode(self, coeffs):
+    def decode(self, coeffs, shape=None):
+        # Inverse of encode (float64 image) or of encode_pyramid. The output is cropped to shape, by default the
+        # source size kept by encode; plain (LL, LH, HL, HH) tuples give the full 2x size of the bands
+        if isinstance(coeffs, DWTPyramid):
+            return self.decode_pyramid(coeffs)
+
         LL, LH, HL, HH = coeffs
-        h, w = LL.shape
+        *batch, h, w = LL.shape
 
         # Vertical reconstruction
-        L_rec = np.zeros((h * 2, w))
-        H_rec = np.zeros((h * 2, w))
+        L_rec = np.zeros((*batch, h * 2, w))
+        H_rec = np.zeros((*batch, h * 2, w))
         # Apply (A = L + H) in the evens, and (B = L - H) in the odds
-        L_rec[0::2, :] = LL + LH
-        L_rec[1::2, :] = LL - LH
+        L_rec[..., 0::2, :] = LL + LH
+        L_rec[..., 1::2, :] = LL - LH
         
-        H_rec[0::2, :] = HL + HH
-        H_rec[1::2, :] = HL - HH
+        H_rec[..., 0::2, :] = HL + HH
+        H_rec[..., 1::2, :] = HL - HH
 
         #Horizontal reconstruction
-        img_rec = np.zeros((h * 2, w * 2))
+        img_rec = np.zeros((*batch, h * 2, w * 2))
         
         # Apply (A = L + H) in the evens, and (B = L - H) in the odds
-        img_rec[:, 0::2] = L_rec + H_rec
-        img_rec[:, 1::2] = L_rec - H_rec
+        img_rec[..., :, 0::2] = L_rec + H_rec
+        img_rec[..., :, 1::2] = L_rec - H_rec
 
+        shape = shape or getattr(coeffs, "shape", None)
+        if shape is not None:
+            img_rec = img_rec[..., :shape[0], :shape[1]]
         return img_rec
\ No newline at end of file
@@ -1,46 +1,137 @@
+import json
+import math
 import ffmpeg
+from .ffmpeg_pool import pool
+from .probe import probe_video
+
+CUT_MODES = ['auto', 'copy', 'accurate']
+
+def time_window(start=None, end=None, duration=None, default=(0.0, None)):
+    # (start, end) in seconds from the optional start/end/duration of a request, end None means until the end.
+    # Without any of them the default window of the function is used.
+    if start is None and end is None and duration is None:
+        return default
+    start = float(start or 0.0)
+    if duration is not None:
+        if end is not None:
+            raise ValueError("Give either end or duration, not both")
+        end = start + float(duration)
+    end = float(end) if end is not None else None
+    if start < 0 or (end is not None and end <= start):
+        raise ValueError("The time window needs 0 <= start < end")
+    return start, end
+
+def seek_options(start=0.0, end=None):
+    # Input options of the window: -ss before -i seeks straight to the keyframe before start and then decodes
+    # only up to start (accurate when transcoding), instead of decoding the whole beginning of the file
+    options = {}
+    if start:
+        options['ss'] = start
+    if end is not None:
+        options['to'] = end
+    return options
+
+def cut_duration(video_path, start, end=None):
+    # Length in seconds of the part of the video between start and end
+    duration = probe_video(video_path).duration
+    return max(min(duration, end if end is not None else math.inf) - start, 0.0)
+
+def video_packets(video_path, start=None, end=None):
+    # (pts seconds, is keyframe) of the packets of the first video stream between start and end, sorted by pts.
+    # Reads the packet headers only, nothing is decoded.
+    args = ["ffprobe", "-v", "error", "-select_streams", "v:0"]
+    if start is not None or end is not None:
+        args += ["-read_intervals", f"{max((start or 0) - 1, 0)}%{end + 1 if end is not None else ''}"]
+    args += ["-show_entries", "packet=pts_time,flags", "-of", "json", video_path]
+    stdout, _ = pool.submit_args(args, capture_stdout=True, capture_stderr=True).result()
+    packets = [
+        (float(packet['pts_time']), 'K' in packet.get('flags', ''))
+        for packet in json.loads(stdout.decode("utf-8")).get('packets', [])
+        if packet.get('pts_time') not in (None, 'N/A')
+    ]
+    return sorted(packet for packet in packets if (start is None or packet[0] >= start - 1) and (end is None or packet[0] <= end + 1))
+
+def starts_on_keyframe(video_path, start):
+    # True when a video keyframe is within half a frame of start, so a stream copy cut begins exactly there.
+    # start counts from the beginning of the file like -ss, ffprobe timestamps also include the container start time
+    if start <= 0:
+        return True
+    metadata = probe_video(video_path)
+    video = metadata.video
+    tolerance = 0.5 / video.frame_rate if video and video.frame_rate else 0.02
+    position = start + metadata.start_time
+    return any(key and abs(pts - position) <= tolerance for pts, key in video_packets(video_path, position, position))
+
+def cut_video(input_video_path, output_video_path, start=0.0, end=None, mode='auto', progress=None):
+    # Trims the video. copy never re-encodes (it starts at the keyframe before start), accurate always re-encodes,
+    # auto copies when start lands on a keyframe and re-encodes otherwise. Returns (output path, copied)
+    if mode not in CUT_MODES:
+        raise ValueError(f"Invalid cut mode, choose: {', '.join(CUT_MODES)}")
+    copy = mode == 'copy' or (mode == 'auto' and starts_on_keyframe(input_video_path, start))
+    stream = ffmpeg.input(input_video_path, **seek_options(start, end))
+    if copy:
+        #every stream as it is, timestamps shifted to start at 0
+        options = {'map': 0, 'c': 'copy', 'avoid_negative_ts': 'make_zero'}
+    else:
+        options = {}
+    stream = ffmpeg.output(stream, output_video_path, **options, **faststart(output_video_path))
+    duration = cut_duration(input_video_path, start, end) if progress else 0
+    pool.run(stream, overwrite_output=True, progress=progress_reporter(progress, duration))
+    return output_video_path, copy
+
+def faststart(output_video_path):
+    # MP4/MOV outputs get the moov atom at the front, so a player can start and seek before the whole file is downloaded
+    if output_video_path.lower().endswith(('.mp4', '.mov', '.m4v')):
+        return {'movflags': '+faststart'}
+    return {}
+
+def progress_reporter(progress, duration):
+    # Turns the seconds reported by the ffmpeg pool into a 0-1 fraction for the progress callback
+    if progress is None:
+        return None
+    return lambda seconds: progress(min(seconds / duration, 1.0) if duration > 0 else 0.0)
 
-def change_video_resolution(input_video_path, output_video_path, width, height):
-    stream = ffmpeg.input(input_video_path, ss=20, to=50)
+def change_video_resolution(input_video_path, output_video_path, width, height, progress=None, output_options=None, start=20, end=50):
+    # output_options are extra encoder arguments, e.g. {'vcodec': 'libx264', 'b:v': '1M'}
+    stream = ffmpeg.input(input_video_path, **seek_options(start, end))
     stream = ffmpeg.filter(stream, 'scale', width, height)
-    stream = ffmpeg.output(stream, output_video_path)
-    ffmpeg.run(stream, overwrite_output=True)
+    stream = ffmpeg.output(stream, output_video_path, **{**faststart(output_video_path), **(output_options or {})})
+    duration = cut_duration(input_video_path, start, end) if progress else 0
+    pool.run(stream, overwrite_output=True, progress=progress_reporter(progress, duration))
     return output_video_path
 
-def change_chroma_subsampling(input_video_path, output_video_path, subsampling):
-    stream = ffmpeg.input(input_video_path)
-    stream = ffmpeg.output(stream, output_video_path, vf=f"format=yuv{subsampling}")
-    ffmpeg.run(stream)
+def change_chroma_subsampling(input_video_path, output_video_path, subsampling, start=0, end=None):
+    stream = ffmpeg.input(input_video_path, **seek_options(start, end))
+    stream = ffmpeg.output(stream, output_video_path, vf=f"format=yuv{subsampling}", **faststart(output_video_path))
+    pool.run(stream)
     return output_video_path
 
 def get_video_info(video_path):
-    probe = ffmpeg.probe(video_path)
-    format_info = probe.get('format', {})
-
-    video_stream = next((s for s in probe['streams'] if s.get('codec_type') == 'video'), None)
+    metadata = probe_video(video_path)  #cached, the endpoint or an earlier step may have probed it already
+    video_stream = metadata.video
 
     if not video_stream:
         print("No video stream found")
         return None
     
     relevant_data = {
-        "Video duration (seconds)": float(format_info.get('duration', 0.0)),
-        "Video resolution": f"{video_stream.get('width', 0)}x{video_stream.get('height', 0)}",
-        "Video codec": video_stream.get('codec_name'),
-        "Video framerate (fps)": eval(video_stream.get('r_frame_rate', '0/1')),
-        "Video bitrate (kbps)": float(format_info.get('bit_rate', 0)) // 1000,
-        "Chroma subsampling": video_stream.get('pix_fmt'),
+        "Video duration (seconds)": metadata.duration,
+        "Video resolution": f"{video_stream.width}x{video_stream.height}",
+        "Video codec": video_stream.codec_name,
+        "Video framerate (fps)": video_stream.frame_rate,
+        "Video bitrate (kbps)": float(metadata.bit_rate) // 1000,
+        "Chroma subsampling": video_stream.pix_fmt,
     }
 
     return relevant_data
 
-def process_bbb(input_video_path, output_video_path):
-    input_stream = ffmpeg.input(input_video_path, ss=0, to=20)  #Cut the first 20 seconds
+def process_bbb(input_video_path, output_video_path, start=0, end=20):
+    input_stream = ffmpeg.input(input_video_path, **seek_options(start, end))  #Cut the first 20 seconds by default
 
     video_stream = input_stream.video
     audio_stream = input_stream.audio
 
-    (
+    stream = (
         ffmpeg
         .output(
             video_stream,
@@ -66,10 +157,12 @@ def process_bbb(input_video_path, output_video_path):
                 '-c:a:2': 'ac3',
                 '-ac:a:2': '2',
                 '-b:a:2': '192k',
+
+                **faststart(output_video_path),
             }
         )
-        .run(overwrite_output=True)
     )
+    pool.run(stream, overwrite_output=True)
 
 
 def count_tracks(video_path):
@@ -77,15 +170,15 @@ def count_tracks(video_path):
         raise ValueError("The function only supports .mp4 files.")
 
 
-    probe = ffmpeg.probe(video_path)  #probe function as exercice 3
-    multimedia_files = probe.get('streams', [])  #creates an array of all streams in the container
+    metadata = probe_video(video_path)  #probe function as exercice 3, cached
+    multimedia_files = metadata.streams  #all streams in the container
     
     total_tracks = len(multimedia_files) #count the total number of tracks
     
     #this is complately optional but it looks very visual
-    audio_tracks = len([s for s in multimedia_files if s['codec_type'] == 'audio'])
-    video_tracks = len([s for s in multimedia_files if s['codec_type'] == 'video'])
-    subtitle_tracks = len([s for s in multimedia_files if s['codec_type'] == 'subtitle'])
+    audio_tracks = metadata.count('audio')
+    video_tracks = metadata.count('video')
+    subtitle_tracks = metadata.count('subtitle')
     
     return {
         "total_tracks": total_tracks,   #THE ONLY IMPORTANT OF THE EXERCICE
@@ -98,16 +191,16 @@ def count_tracks(video_path):
     }
 
 
-def visualize_motion_vectors(input_video_path, output_video_path):   
-    stream = ffmpeg.input(input_video_path, ss=20, to=50, flags2='+export_mvs')  #export motion vectors information of the video
-    stream = ffmpeg.output(stream, output_video_path, vf='codecview=mv=pf+bf+bb')  #paint the motion vectors on the video
-    ffmpeg.run(stream)
+def visualize_motion_vectors(input_video_path, output_video_path, start=20, end=50):   
+    stream = ffmpeg.input(input_video_path, flags2='+export_mvs', **seek_options(start, end))  #export motion vectors information of the video
+    stream = ffmpeg.output(stream, output_video_path, vf='codecview=mv=pf+bf+bb', **faststart(output_video_path))  #paint the motion vectors on the video
+    pool.run(stream)
     
     return output_video_path
 
-def show_yuv_histogram(input_video_path, output_video_path):
-    stream = ffmpeg.input(input_video_path, ss=20, to=50)
+def show_yuv_histogram(input_video_path, output_video_path, start=20, end=50):
+    stream = ffmpeg.input(input_video_path, **seek_options(start, end))
     #stream = ffmpeg.output(stream, output_video_path, vf='histogram=yuv=1', vframes=1) DOESN'T WORK
-    stream = ffmpeg.output(stream, output_video_path, vf="split=2[a][b],[b]histogram,format=yuva444p[hh],[a][hh]overlay=x=10:y=10,format=yuv420p")
-    ffmpeg.run(stream, overwrite_output=True, capture_stdout=True, capture_stderr=True)
+    stream = ffmpeg.output(stream, output_video_path, vf="split=2[a][b],[b]histogram,format=yuva444p[hh],[a][hh]overlay=x=10:y=10,format=yuv420p", **faststart(output_video_path))
+    pool.run(stream, overwrite_output=True, capture_stdout=True, capture_stderr=True)
     return output_video_path
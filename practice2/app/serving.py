@@ -0,0 +1,35 @@
+# HTTP serving of produced files
+# Range requests (206) come from Starlette's FileResponse, this adds a stable ETag and answers conditional GETs with
+# 304 so players seeking in a video, or a GUI reloading it, only download what they don't already have.
+import hashlib
+from email.utils import formatdate, parsedate_to_datetime
+
+from fastapi.responses import FileResponse, Response
+
+def file_etag(stat):
+    # Changes whenever the file is replaced or rewritten
+    tag = hashlib.md5(f"{stat.st_ino}-{stat.st_size}-{stat.st_mtime_ns}".encode("utf-8"), usedforsecurity=False)
+    return f'"{tag.hexdigest()}"'
+
+def not_modified(request, etag, mtime):
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        #If-None-Match wins over If-Modified-Since, weak validators are compared as strong ones for GET
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def conditional_file_response(request, path, media_type=None, filename=None, headers=None, cache_control="private, max-age=3600"):
+    # FileResponse with ETag, Last-Modified and Accept-Ranges, or an empty 304 when the client's copy is current
+    stat = path.stat()
+    headers = {**(headers or {}), "etag": file_etag(stat), "cache-control": cache_control}
+    if not_modified(request, headers["etag"], stat.st_mtime):
+        headers["last-modified"] = formatdate(stat.st_mtime, usegmt=True)
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path=path, media_type=media_type, filename=filename, headers=headers, stat_result=stat)
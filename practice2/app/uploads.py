@@ -0,0 +1,285 @@
+# Streaming ingestion of multipart uploads
+# With UploadFile, Starlette first spools the whole upload to its own temp file and then the endpoint copies it
+# again. Here the request body is parsed while it arrives: the file goes straight into the workspace in big chunks
+# and is hashed on the way, the size is limited, and the first megabytes are probed with ffprobe while the rest is
+# still uploading, so a file that is not a video is rejected before the whole body is written.
+# Instead of a file, a request can also send media_path: a file inside SCAV_MEDIA_ROOT that ffmpeg reads in place.
+import asyncio
+import hashlib
+import os
+from pathlib import Path
+from urllib.parse import parse_qsl
+
+from fastapi.concurrency import run_in_threadpool
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:
+    from multipart.multipart import MultipartParser, parse_options_header
+
+
+MAX_UPLOAD_BYTES = int(os.environ.get("SCAV_MAX_UPLOAD_BYTES", 8 * 1024 ** 3))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+PROBE_HEADER_BYTES = 4 * 1024 * 1024
+PROBE_TIMEOUT = 10
+# Folder whose files can be processed without uploading them, disabled when not set
+MEDIA_ROOT = os.environ.get("SCAV_MEDIA_ROOT")
+MAX_FORM_BYTES = 64 * 1024
+
+class UploadError(Exception):
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+class StreamedUpload:
+    __slots__ = ("path", "filename", "size", "digest", "fields")
+
+    def __init__(self, path, filename, size, digest, fields):
+        self.path = path
+        self.filename = filename
+        self.size = size
+        self.digest = digest
+        self.fields = fields
+
+    def field(self, name, type=str, default=None):
+        # Form field converted to type, raises UploadError (400) when it can't be
+        if name not in self.fields or self.fields[name] == "":
+            return default
+        value = self.fields[name]
+        try:
+            if type is bool:
+                if value.lower() not in ("true", "false", "1", "0", "on", "off"):
+                    raise ValueError()
+                return value.lower() in ("true", "1", "on")
+            return type(value)
+        except ValueError:
+            raise UploadError(f"Invalid value for {name}: {value}")
+
+async def probe_header(path):
+    # Probes the bytes received so far. Returns an error message only when ffprobe is sure the data is not
+    # media: an MP4 with the moov atom at the end can't be probed from its beginning and is let through.
+    # ffprobe runs as an asyncio subprocess outside the ffmpeg pool, so the check never waits behind the encodes.
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffprobe", "-v", "error", str(path), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+        )
+    except OSError:
+        return None
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), PROBE_TIMEOUT)
+    except asyncio.TimeoutError:
+        #a slow check doesn't reject anything
+        process.kill()
+        await process.wait()
+        return None
+    except asyncio.CancelledError:
+        #the upload ended before the check
+        if process.returncode is None:
+            process.kill()
+        raise
+    if process.returncode != 0 and "Invalid data found when processing input" in stderr.decode("utf-8", "replace"):
+        return "The uploaded file is not a video or audio file ffmpeg can read"
+    return None
+
+def resolve_media_path(reference, media_root=None):
+    # Path of a file inside the media root, refusing anything that resolves outside of it (.., absolute paths, symlinks)
+    media_root = media_root or MEDIA_ROOT
+    if not media_root:
+        raise UploadError("Processing server side files is disabled, SCAV_MEDIA_ROOT is not set", 403)
+    root = Path(media_root).resolve()
+    path = (root / reference).resolve()
+    if not path.is_relative_to(root):
+        raise UploadError("media_path must be inside the media root", 403)
+    if not path.is_file():
+        raise UploadError(f"File not found in the media root: {reference}", 404)
+    return path
+
+def media_input(fields):
+    # StreamedUpload of a file read in place. The cache key uses its path, size and mtime instead of hashing its bytes.
+    path = resolve_media_path(fields["media_path"])
+    stat = path.stat()
+    digest = hashlib.sha256(f"media:{path}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8")).hexdigest()
+    return StreamedUpload(path, path.name, stat.st_size, digest, fields)
+
+def safe_filename(filename):
+    return Path(filename or "uploaded_file").name or "uploaded_file"
+
+class MultipartReceiver:
+    # Collects the parser callbacks, the endpoint coroutine then does the slow work (disk, probe) between chunks
+    def __init__(self, file_field):
+        self.file_field = file_field
+        self.fields = {}
+        self.filename = None
+        self.pending = []
+        self.file_seen = False
+        self._header_field = b""
+        self._header_value = b""
+        self._headers = {}
+        self._name = None
+        self._is_file = False
+        self._value = []
+        self._value_size = 0
+
+    def callbacks(self):
+        return {
+            "on_part_begin": self.on_part_begin,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+        }
+
+    def on_part_begin(self):
+        self._headers = {}
+        self._value = []
+        self._value_size = 0
+
+    def on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        self._name = options.get(b"name", b"").decode("utf-8", "replace")
+        self._is_file = self._name == self.file_field and b"filename" in options
+        if self._is_file:
+            if self.file_seen:
+                raise UploadError("Only one file can be uploaded")
+            self.file_seen = True
+            self.filename = options[b"filename"].decode("utf-8", "replace")
+
+    def on_part_data(self, data, start, end):
+        if self._is_file:
+            self.pending.append(bytes(data[start:end]))
+        else:
+            #form fields are kept in memory: a file sent in another field must not fill it
+            self._value_size += end - start
+            if self._value_size > MAX_FORM_BYTES:
+                raise UploadError(f"Form field {self._name} is bigger than {MAX_FORM_BYTES} bytes, only '{self.file_field}' can hold a file", 413)
+            self._value.append(bytes(data[start:end]))
+
+    def on_part_end(self):
+        if not self._is_file and self._name:
+            self.fields[self._name] = b"".join(self._value).decode("utf-8", "replace")
+
+class UploadWriter:
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.digest = hashlib.sha256()
+        self.file = open(path, "wb")
+
+    def write(self, chunks):
+        for chunk in chunks:
+            self.size += len(chunk)
+            if self.size > self.max_bytes:
+                raise UploadError(f"The upload is bigger than the limit of {self.max_bytes} bytes", 413)
+            self.digest.update(chunk)
+            self.file.write(chunk)
+        #flushed so the probe sees the bytes received so far
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+async def receive_upload(request, folder, file_field="file", max_bytes=MAX_UPLOAD_BYTES, probe=True, prefix=""):
+    # Parses the multipart body of request, writes the file into folder (as prefix + its name) and returns a
+    # StreamedUpload. A request with media_path instead of a file returns the server side file without copying it.
+    # Raises UploadError with the HTTP status to answer when the request is rejected.
+    content_type = request.headers.get("content-type", "")
+    kind, options = parse_options_header(content_type)
+    if kind == b"application/x-www-form-urlencoded":
+        #no file in the body, only the fields and a media_path
+        body = b""
+        async for chunk in request.stream():
+            body += chunk
+            if len(body) > MAX_FORM_BYTES:
+                raise UploadError("Form too large, upload files as multipart/form-data", 413)
+        fields = dict(parse_qsl(body.decode("utf-8", "replace"), keep_blank_values=True))
+        if not fields.get("media_path"):
+            raise UploadError(f"Missing file field '{file_field}' or media_path")
+        return await run_in_threadpool(media_input, fields)
+    if kind != b"multipart/form-data" or b"boundary" not in options:
+        raise UploadError("The request must be multipart/form-data or application/x-www-form-urlencoded")
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes + 64 * 1024:
+        raise UploadError(f"The upload is bigger than the limit of {max_bytes} bytes", 413)
+
+    receiver = MultipartReceiver(file_field)
+    parser = MultipartParser(options[b"boundary"], receiver.callbacks())
+    writer = None
+    buffered = 0
+    probe_task = None
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if receiver.file_seen and writer is None:
+                path = Path(folder) / (prefix + safe_filename(receiver.filename))
+                writer = await run_in_threadpool(UploadWriter, path, max_bytes)
+            buffered = sum(len(data) for data in receiver.pending)
+            if writer is not None and buffered >= UPLOAD_CHUNK_SIZE:
+                pending, receiver.pending = receiver.pending, []
+                await run_in_threadpool(writer.write, pending)
+
+            #start probing as soon as the header is on disk, and stop the upload if it is not media
+            if probe and probe_task is None and writer is not None and writer.size >= PROBE_HEADER_BYTES:
+                probe_task = asyncio.ensure_future(probe_header(writer.path))
+            if probe_task is not None and probe_task.done() and probe_task.result():
+                raise UploadError(probe_task.result(), 415)
+        parser.finalize()
+
+        if receiver.fields.get("media_path"):
+            if writer is not None:
+                raise UploadError("Send either a file or a media_path, not both")
+            return await run_in_threadpool(media_input, receiver.fields)
+        if writer is None:
+            raise UploadError(f"Missing file field '{file_field}' or media_path")
+        await run_in_threadpool(writer.write, receiver.pending)
+        receiver.pending = []
+        if probe_task is not None and await probe_task:
+            raise UploadError(probe_task.result(), 415)
+    except UploadError:
+        raise
+    except Exception as e:
+        if type(e).__name__ in ("ClientDisconnect", "FormParserError", "MultipartParseError"):
+            raise UploadError(f"Invalid or interrupted upload: {e}")
+        raise
+    finally:
+        if writer is not None:
+            await run_in_threadpool(writer.close)
+        if probe_task is not None and not probe_task.done():
+            probe_task.cancel()
+
+    return StreamedUpload(writer.path, safe_filename(receiver.filename), writer.size, writer.digest.hexdigest(), receiver.fields)
+
+def multipart_form(**fields):
+    # OpenAPI description of a multipart body with a file and form fields, so /docs still shows the upload form
+    # for endpoints that read the body with receive_upload. fields: name=(type, default, description)
+    properties = {
+        "file": {"type": "string", "format": "binary"},
+        "media_path": {"type": "string", "description": "Instead of a file: path of a video inside the server's media root"},
+    }
+    for name, (type, default, description) in fields.items():
+        properties[name] = {"type": type, "description": description}
+        if default is not None:
+            properties[name]["default"] = default
+    without_file = {name: value for name, value in properties.items() if name != "file"}
+    return {
+        "requestBody": {
+            "required": True,
+            "content": {
+                "multipart/form-data": {"schema": {"type": "object", "properties": properties}},
+                "application/x-www-form-urlencoded": {"schema": {"type": "object", "required": ["media_path"], "properties": without_file}},
+            },
+        }
+    }
@@ -0,0 +1,120 @@
+# Private temporary folders for the requests
+# Each request works in its own folder inside the temp dir, so parallel requests never delete each other's files.
+# The folder is removed when the request ends, or after the response is sent when it serves a file from it,
+# and a periodic sweep removes whatever is left behind (crashes, aborted downloads) and keeps the disk usage bounded.
+import os
+import shutil
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+from starlette.background import BackgroundTask
+from fastapi.responses import FileResponse, StreamingResponse
+
+def folder_size(path):
+    if path.is_file():
+        return path.stat().st_size
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def remove_path(path):
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    elif path.exists():
+        try:
+            path.unlink()
+        except OSError:
+            pass
+
+class WorkspaceManager:
+    def __init__(self, root, max_age=None, max_bytes=None):
+        #absolute, so the folders of iterdir() compare equal to the ones mkdtemp returned (absolute since Python 3.12)
+        self.root = Path(root).resolve()
+        #seconds a finished workspace may stay on disk, and total size of the temp dir before the oldest are deleted
+        self.max_age = max_age if max_age is not None else float(os.environ.get("SCAV_TEMP_MAX_AGE", 3600))
+        self.max_bytes = max_bytes if max_bytes is not None else int(os.environ.get("SCAV_TEMP_MAX_BYTES", 10 * 1024 ** 3))
+        self._lock = threading.Lock()
+        self._active = set()
+        self._handed_off = set()
+        self.removed = 0
+
+    def create(self):
+        self.root.mkdir(parents=True, exist_ok=True)
+        workspace = Path(tempfile.mkdtemp(prefix="req_", dir=self.root)).resolve()
+        with self._lock:
+            self._active.add(workspace)
+        return workspace
+
+    def file_response(self, workspace, path, filename, media_type):
+        # FileResponse that deletes the workspace once the file has been sent
+        with self._lock:
+            self._handed_off.add(workspace)
+        return FileResponse(path=path, filename=filename, media_type=media_type, background=BackgroundTask(self.remove, workspace))
+
+    def streaming_response(self, workspace, content, media_type, headers=None):
+        # StreamingResponse generated from files of the workspace, which is deleted once everything was sent
+        with self._lock:
+            self._handed_off.add(workspace)
+        return StreamingResponse(content, media_type=media_type, headers=headers, background=BackgroundTask(self.remove, workspace))
+
+    def hand_off(self, workspace):
+        # The caller takes care of removing the workspace later (for responses other than file_response)
+        with self._lock:
+            self._handed_off.add(workspace)
+
+    def release(self, workspace):
+        # Called when the request ends: removes the workspace unless a response still needs it
+        with self._lock:
+            self._active.discard(workspace)
+            if workspace in self._handed_off:
+                return
+        self.remove(workspace)
+
+    def remove(self, workspace):
+        remove_path(workspace)
+        with self._lock:
+            self._active.discard(workspace)
+            self._handed_off.discard(workspace)
+            self.removed += 1
+
+    def sweep(self):
+        # Deletes entries older than max_age, then the oldest ones until the temp dir fits in max_bytes.
+        # Workspaces of requests that are still running are never touched.
+        if not self.root.exists():
+            return {"removed": 0, "bytes": 0}
+        now = time.time()
+        with self._lock:
+            active = set(self._active)
+        entries = []
+        for entry in self.root.iterdir():
+            if entry in active:
+                continue
+            try:
+                mtime = entry.stat().st_mtime
+            except OSError:
+                continue
+            entries.append((mtime, entry, folder_size(entry)))
+
+        removed = 0
+        total = sum(size for _, _, size in entries)
+        for mtime, entry, size in sorted(entries, key=lambda item: item[0]):
+            if now - mtime <= self.max_age and total <= self.max_bytes:
+                break
+            remove_path(entry)
+            with self._lock:
+                self._handed_off.discard(entry)
+            total -= size
+            removed += 1
+        self.removed += removed
+        return {"removed": removed, "bytes": total}
+
+    def stats(self):
+        with self._lock:
+            return {"active": len(self._active), "pending_delete": len(self._handed_off), "removed": self.removed}
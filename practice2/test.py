@@ -0,0 +1,97 @@
+import unittest
+import numpy as np
+
+# Tests del format binari de run length encoding de s1_functions
+# S'executen des de la carpeta practice2 amb: python -m unittest test
+from app.s1_functions import (
+    run_length_encoding, rle_encode, rle_decode, rle_to_bytes, rle_from_bytes, RLE_MAGIC
+)
+
+def header(n_runs):
+    return RLE_MAGIC + np.uint64(n_runs).astype('<u8').tobytes()
+
+class TestRunLengthFormat(unittest.TestCase):
+
+    def setUp(self):
+        """Dades amb runs de llargades diferents, algunes de més de 127 (varints de 2 bytes)."""
+        rng = np.random.default_rng(0)
+        self.data = np.repeat(rng.integers(0, 4, 500, dtype=np.uint8), rng.integers(1, 300, 500)).tobytes()
+
+    # --- ROUND TRIP ---
+
+    def test_rle_encode_matches_reference(self):
+        """Prova que la versió vectoritzada dona els mateixos runs que run_length_encoding."""
+        values, lengths = rle_encode(self.data)
+        expected = run_length_encoding(self.data)
+        self.assertEqual(list(zip(values.tolist(), lengths.tolist())), expected)
+        print("[OK] rle_encode == run_length_encoding verified.")
+
+    def test_bytes_round_trip(self):
+        """Prova que encode -> bytes -> decode recupera les dades originals."""
+        values, lengths = rle_encode(self.data)
+        values_out, lengths_out = rle_from_bytes(rle_to_bytes(values, lengths))
+        np.testing.assert_array_equal(values, values_out)
+        np.testing.assert_array_equal(lengths, lengths_out)
+        self.assertEqual(rle_decode(values_out, lengths_out).tobytes(), self.data)
+        print("[OK] RLE bytes round trip verified.")
+
+    def test_empty_round_trip(self):
+        """Una entrada buida també ha de sobreviure el round trip."""
+        values, lengths = rle_from_bytes(rle_to_bytes(*rle_encode(b"")))
+        self.assertEqual(values.size, 0)
+        self.assertEqual(rle_decode(values, lengths).size, 0)
+        print("[OK] Empty RLE round trip verified.")
+
+    def test_long_runs_round_trip(self):
+        """Llargades de fins a 63 bits (varints de 9 bytes) es llegeixen igual que s'han escrit."""
+        lengths = np.array([1, 127, 128, 2 ** 35, 2 ** 63 - 1], dtype=np.int64)
+        values = np.arange(lengths.size, dtype=np.uint8)
+        _, lengths_out = rle_from_bytes(rle_to_bytes(values, lengths), max_bytes=2 ** 63 - 1)
+        np.testing.assert_array_equal(lengths, lengths_out)
+        print("[OK] Long run lengths verified.")
+
+    # --- DADES CORROMPUDES ---
+
+    def test_truncated_header(self):
+        """Un stream més curt que la capçalera (magic + nombre de runs) s'ha de rebutjar."""
+        for payload in (b"", b"RLE", RLE_MAGIC + b"\x01\x00"):
+            with self.assertRaises(ValueError):
+                rle_from_bytes(payload)
+        print("[OK] Truncated header rejected.")
+
+    def test_wrong_magic(self):
+        with self.assertRaises(ValueError):
+            rle_from_bytes(b"JUNK" + bytes(8))
+        print("[OK] Wrong magic rejected.")
+
+    def test_truncated_body(self):
+        """Falten valors, falten llargades o l'últim varint no s'acaba."""
+        payload = rle_to_bytes(*rle_encode(self.data))
+        for cut in (13, len(payload) - 1):
+            with self.assertRaises(ValueError):
+                rle_from_bytes(payload[:cut])
+        with self.assertRaises(ValueError):
+            rle_from_bytes(header(1) + b"\x07" + b"\x80")
+        print("[OK] Truncated body rejected.")
+
+    def test_oversized_output(self):
+        """Uns pocs bytes que declaren runs de terabytes no han de reservar memòria."""
+        bomb = header(1) + b"\x07" + b"\xff\xff\xff\xff\xff\x7f"
+        self.assertEqual(len(bomb), 19)
+        with self.assertRaises(ValueError):
+            rle_from_bytes(bomb)
+        with self.assertRaises(ValueError):
+            rle_decode([1, 2], [2 ** 62, 2 ** 62])
+        with self.assertRaises(ValueError):
+            rle_from_bytes(rle_to_bytes([1], [1000]), max_bytes=999)
+        print("[OK] Oversized output rejected.")
+
+    def test_overlong_varint(self):
+        """Un varint de més de 9 bytes no cap en 64 bits."""
+        with self.assertRaises(ValueError):
+            rle_from_bytes(header(1) + b"\x07" + b"\x80" * 9 + b"\x01")
+        print("[OK] Overlong varint rejected.")
+
+if __name__ == '__main__':
+    print("=== RUNNING RUN LENGTH FORMAT UNIT TESTS ===")
+    unittest.main()